@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+import pymongo
+import pytest
+from bson import ObjectId
+
+import ssverification
+from listings import ads_per_page, listing, page_url, site
+
+
+@pytest.fixture(scope='session')
+def recorded(tmp_path_factory):
+    """ Returns a replay folder, as written by --record, with a listing of about the given number of ads. """
+    folders = {}
+
+    def record(ads):
+        if ads not in folders:
+            folder = tmp_path_factory.mktemp('replay-%d' % ads)
+            pages = max(ads // ads_per_page, 1)
+            index = {}
+            for page in range(1, pages + 1):
+                name = hashlib.sha1(page_url(page).encode()).hexdigest() + '.html'
+                with open(os.path.join(folder, name), 'w', encoding='utf-8') as f:
+                    f.write(listing(page, pages))
+                index[page_url(page)] = {'file': name, 'encoding': 'utf-8'}
+            with open(os.path.join(folder, 'index.json'), 'w') as f:
+                json.dump(index, f)
+            folders[ads] = str(folder)
+        return folders[ads]
+    return record
+
+
+@pytest.fixture
+def replay(monkeypatch, recorded):
+    """ Points the crawl at a replay folder, without page cache and politeness delay. """
+    def use(ads):
+        monkeypatch.setattr(ssverification, 'session', ssverification.create_session(replay_folder=recorded(ads)))
+        monkeypatch.setattr(ssverification, 'cache', None)
+        monkeypatch.setitem(ssverification.config, 'crawl.delay', 0)
+        monkeypatch.setitem(ssverification.config, 'sites', [site])
+        return [site]
+    return use
+
+
+def stored_documents(index, changed_every=10):
+    """ Stored ads of a crawled index, every changed_every-th one with an older price and listing row. """
+    documents = []
+    for i, a in enumerate(index.values()):
+        document = a.to_document(None)
+        document['_id'] = ObjectId()
+        document['kind'] = 'ad'
+        if i % changed_every == 0:
+            document['price'] = '%d €' % (a.price + 1000)
+            del document['fingerprint']
+        documents.append(document)
+    return documents
+
+
+@pytest.fixture
+def crawled(replay):
+    """ Returns the url index of a replayed crawl of about the given number of ads. """
+    return lambda ads: ssverification.build_model(ssverification.request_ss_records(replay(ads)))
+
+
+@pytest.fixture
+def stored(crawled):
+    """ Returns the crawled index and its stored ads, see stored_documents. """
+    def crawl(ads):
+        index = crawled(ads)
+        return index, stored_documents(index)
+    return crawl
+
+
+@pytest.fixture
+def mongo():
+    """ mongomock, or the server at BENCHMARK_MONGO_URL. """
+    url = os.environ.get('BENCHMARK_MONGO_URL')
+    if not url:
+        mongomock = pytest.importorskip('mongomock')
+        yield mongomock.MongoClient()
+        return
+    client = pymongo.MongoClient(url)
+    yield client
+    client.drop_database('ss_ads')
+    client.close()
+
+
+@pytest.fixture
+def verification(monkeypatch, mongo):
+    """ The per-cycle state run_cycle sets up, writing into the benchmark database. """
+    def start():
+        db = mongo.ss_ads
+        # Module globals which only exist once run_cycle ran.
+        monkeypatch.setattr(ssverification, 'writer', ssverification.BulkWriter(db[ssverification.ss_ad_collection]),
+                            raising=False)
+        monkeypatch.setattr(ssverification, 'history',
+                            ssverification.BulkWriter(db[ssverification.price_history_collection]), raising=False)
+        monkeypatch.setattr(ssverification, 'events', ssverification.EventLog(), raising=False)
+        monkeypatch.setattr(ssverification, 'missing', [], raising=False)
+        return db
+    return start
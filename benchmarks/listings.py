@@ -0,0 +1,29 @@
+""" Synthetic ss.com listing pages for the benchmarks. """
+site = 'https://www.ss.com/lv/real-estate/flats/riga/centre/sell/'
+ads_per_page = 30
+
+
+def row(i):
+    """ A listing row laid out like the ss.com flats listings. """
+    url = '/msg/lv/real-estate/flats/riga/centre/ad%d.html' % i
+    cells = ['Iela %d' % (i % 500), str(1 + i % 4), str(30 + i % 70), '%d/%d' % (1 + i % 5, 5 + i % 3), 'P. kara',
+             '%d €' % (1000 + i % 900), '%d,000 €' % (50 + i % 300)]
+    tds = ''.join('<td class="msga2-o pp6" c="1">%s</td>' % c for c in cells)
+    return ('<tr id="tr_%d"><td class="msga2 pp0"><input type="checkbox"></td>'
+            '<td class="msg2"><div class="d1"><a id="dm_%d" onclick="return false;" class="am" href="%s">'
+            'Pārdod <b>dzīvokli</b><br>centrā</a></div></td>%s</tr>\n' % (i, i, url, tds))
+
+
+def listing(page, pages):
+    """ Page number page of a listing with pages pages. """
+    rows = ''.join(row((page - 1) * ads_per_page + i) for i in range(ads_per_page))
+    # Like on ss.com, the nav block links the next few pages and the last one.
+    numbers = sorted(set(range(page + 1, min(page + 10, pages + 1))) | ({pages} if pages > 1 else set()))
+    nav = ''.join('<a name="nav_id" rel="next" class="navi" href="/lv/real-estate/flats/riga/centre/sell/page%d.html">'
+                  '%d</a>' % (p, p) for p in numbers)
+    return ('<html><head><!-- counters --></head><body><table>%s</table><div class="td2">%s</div></body></html>'
+            % (rows, nav))
+
+
+def page_url(page):
+    return site if page == 1 else site + 'page%d.html' % page
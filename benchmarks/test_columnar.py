@@ -0,0 +1,95 @@
+"""
+verify.mode rows against columnar over synthetic crawls, the columns are built once per cycle as in run_cycle.
+Every tenth stored ad has a changed listing row, every 25th is no longer listed.
+The 1M ads case runs only with BENCHMARK_LARGE set.
+"""
+import os
+
+import pytest
+from bson import ObjectId
+
+import ssverification
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('numpy')
+
+sizes = [10000, 100000, pytest.param(1000000, marks=pytest.mark.skipif(
+    not os.environ.get('BENCHMARK_LARGE'), reason='BENCHMARK_LARGE is not set'))]
+
+
+def items(i):
+    return ['/msg/lv/real-estate/flats/riga/centre/ad%d.html' % i, 'Iela %d' % (i % 500), str(1 + i % 4),
+            str(30 + i % 70), '2/5', 'P. kara', '%d €' % (1000 + i % 900), '%d,000 €' % (50 + i % 300)]
+
+
+def synthetic(ads):
+    index = {}
+    chunks = [[]]
+    for i in range(ads):
+        a = ssverification.build_db_record(items(i))
+        if i % 25:
+            ssverification.to_index(index, a)
+        document = dict(a.fields(), _id=ObjectId())
+        if i % 10 == 0:
+            document['price'] = a.price + 1000
+            document['fingerprint'] = None
+        if len(chunks[-1]) == 1000:
+            chunks.append([])
+        chunks[-1].append(document)
+    return index, chunks
+
+
+@pytest.fixture(scope='module')
+def crawls():
+    cached = {}
+
+    def crawl(ads):
+        if ads not in cached:
+            cached.clear()
+            cached[ads] = synthetic(ads)
+        return cached[ads]
+    return crawl
+
+
+@pytest.fixture
+def verification(monkeypatch):
+    """ Writer, history and event log without a database, the updates stay in their buffers. """
+    def start():
+        for name in ['writer', 'history']:
+            monkeypatch.setattr(ssverification, name, ssverification.BulkWriter(None, batch_size=10 ** 9),
+                                raising=False)
+        monkeypatch.setattr(ssverification, 'events', ssverification.EventLog(), raising=False)
+        monkeypatch.setattr(ssverification, 'missing', [], raising=False)
+    return start
+
+
+def rows(index, chunks):
+    found = set()
+    by_address = ssverification.address_index(index)
+    for chunk in chunks:
+        ssverification.verify_rows(chunk, index, found, by_address)
+    return found
+
+
+def columnar(index, chunks):
+    found = set()
+    by_address = ssverification.address_index(index)
+    columns = ssverification.RemoteColumns(index)
+    for chunk in chunks:
+        ssverification.verify_columnar(chunk, columns, found, by_address)
+    return found
+
+
+@pytest.mark.parametrize('mode', [rows, columnar], ids=['rows', 'columnar'])
+@pytest.mark.parametrize('ads', sizes)
+def test_verify_mode(benchmark, crawls, verification, mode, ads):
+    index, chunks = crawls(ads)
+
+    def setup():
+        verification()
+        return (index, chunks), {}
+
+    found = benchmark.pedantic(mode, setup=setup, rounds=3, iterations=1)
+    assert len(found) == len(index)
+    assert len(ssverification.missing) == len(range(0, ads, 25))
+    assert ssverification.events.counts == {'old_price': len(range(0, ads, 10)) - len(range(0, ads, 50))}
@@ -0,0 +1,34 @@
+"""
+Url index lookups of find_by_url over synthetic crawls of growing size, the time per lookup should stay flat.
+Stored ads missing from the listing fall back to the address index.
+"""
+import pytest
+
+import ssverification
+
+pytest.importorskip('pytest_benchmark')
+
+
+def items(i):
+    return ['/msg/lv/real-estate/flats/riga/centre/ad%d.html' % i, 'Iela %d' % (i % 500), str(1 + i % 4),
+            str(30 + i % 70), '2/5', 'P. kara', '%d €' % (1000 + i % 900), '%d,000 €' % (50 + i % 300)]
+
+
+@pytest.mark.parametrize('ads', [1000, 10000, 100000])
+def test_find_by_url(benchmark, ads):
+    index = {}
+    for i in range(ads):
+        ssverification.to_index(index, ssverification.build_db_record(items(i)))
+    # Every tenth stored ad is gone from the listing.
+    stored = [(a.url.replace('.html', 'x.html') if i % 10 == 0 else a.url, [a.address])
+              for i, a in enumerate(index.values())]
+    by_address = ssverification.address_index(index)
+
+    def lookup():
+        return sum(1 for url, addresses in stored if ssverification.find_by_url(url, addresses, index, by_address))
+
+    found = benchmark.pedantic(lookup, rounds=5, iterations=1)
+    if benchmark.stats:
+        # No stats with --benchmark-disable.
+        benchmark.extra_info['us_per_lookup'] = benchmark.stats.stats.mean / ads * 1e6
+    assert found == ads - len(stored[::10])
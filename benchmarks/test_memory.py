@@ -0,0 +1,78 @@
+"""
+Peak memory of streaming the stored ads, it should not grow with the collection.
+mongomock copies the whole result set when a cursor is opened, so by default the ads come from GeneratedAds,
+which hands out documents one at a time like a server side cursor. Set BENCHMARK_MONGO_URL to use a real server.
+"""
+import os
+import tracemalloc
+
+import pymongo
+import pytest
+from bson import ObjectId
+
+import ssverification
+
+pytest.importorskip('pytest_benchmark')
+
+
+def document(i):
+    return {'_id': ObjectId(), 'kind': 'ad', 'url': 'real-estate/flats/riga/centre/ad%d.html' % i,
+            'address': 'Iela %d' % (i % 500), 'rooms': 2, 'm2': 54, 'level': [2, 5], 'price': 90000 + i,
+            'price_m2': 1600, 'date': None, 'fingerprint': '%040x' % i, 'description': 'Pārdod dzīvokli ' * 40}
+
+
+class GeneratedAds:
+    """ Just enough of a collection for stored_ads: find() yields projected documents as they are generated. """
+
+    def __init__(self, count):
+        self.count = count
+
+    def find(self, query, projection, batch_size=None):
+        for i in range(self.count):
+            d = document(i)
+            yield {key: d[key] for key in d if key == '_id' or key in projection}
+
+
+@pytest.fixture
+def ads():
+    url = os.environ.get('BENCHMARK_MONGO_URL')
+    if not url:
+        yield GeneratedAds
+        return
+    client = pymongo.MongoClient(url)
+    collection = client.ssverification_benchmark.ads
+
+    def fill(count):
+        collection.drop()
+        for i in range(0, count, 10000):
+            collection.insert_many([document(j) for j in range(i, min(i + 10000, count))])
+        return collection
+    yield fill
+    client.drop_database('ssverification_benchmark')
+    client.close()
+
+
+def peak(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def stream(collection):
+    for chunk in ssverification.stored_ads(collection, 1000):
+        pass
+
+
+@pytest.mark.parametrize('count', [10000, 100000])
+def test_stored_ads(benchmark, ads, count):
+    collection = ads(count)
+    benchmark.pedantic(stream, (collection,), rounds=3, iterations=1)
+    benchmark.extra_info['peak_kib'] = peak(lambda: stream(collection)) // 1024
+
+
+def test_stored_ads_memory_is_flat(ads):
+    small, large = peak(lambda: stream(ads(10000))), peak(lambda: stream(ads(100000)))
+    assert large < small * 1.5
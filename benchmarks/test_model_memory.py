@@ -0,0 +1,67 @@
+"""
+Peak memory of the crawled ads model at 100k listing rows: RemoteAd objects in the url index
+against the dicts grouped as {address: {'items': [...]}} the model was built of before.
+"""
+import datetime
+import tracemalloc
+
+import pytest
+
+import ssverification
+
+pytest.importorskip('pytest_benchmark')
+
+count = 100000
+
+
+def items(i):
+    return ['/msg/lv/real-estate/flats/riga/centre/ad%d.html' % i, 'Iela %d' % (i % 500), str(1 + i % 4),
+            str(30 + i % 70), '2/5', 'P. kara', '%d €' % (1000 + i % 900), '%d,000 €' % (50 + i % 300)]
+
+
+def dict_record(items):
+    """ A listing row as the dict model kept it, with the scraped strings. """
+    a = {'url': "/".join(items[0].split('/')[3:]), 'address': items[1], 'date': datetime.datetime.utcnow()}
+    if len(items) == 6:
+        a.update({'m2': items[2], 'level': items[3], 'type': ssverification.config['house.marker'],
+                  'price_m2': items[4], 'price': items[5]})
+    elif len(items) == 8:
+        a.update({'rooms': items[2], 'm2': items[3], 'level': items[4], 'type': items[5],
+                  'price_m2': items[6], 'price': items[7]})
+    return a
+
+
+def dict_model(rows):
+    ads = {}
+    for row in rows:
+        a = dict_record(row)
+        ads.setdefault(a['address'], {'items': []})['items'].append(a)
+    return ads
+
+
+def remote_ad_model(rows):
+    index = {}
+    for row in rows:
+        ssverification.to_index(index, ssverification.build_db_record(row))
+    return index
+
+
+def rows():
+    """ Streamed like a crawl, the model keeps what it needs of each row. """
+    return (items(i) for i in range(count))
+
+
+@pytest.mark.parametrize('model', [remote_ad_model, dict_model], ids=['RemoteAd', 'dicts'])
+def test_model_peak(benchmark, model):
+    benchmark.pedantic(model, setup=lambda: ((rows(),), {}), rounds=3, iterations=1)
+    tracemalloc.start()
+    try:
+        # Kept alive until the peak is read, as the model is during a cycle.
+        built = model(rows())
+        benchmark.extra_info['peak_kib'] = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+    if model is dict_model:
+        assert sum(len(group['items']) for group in built.values()) == count
+    else:
+        assert len(built) == count
@@ -0,0 +1,60 @@
+"""
+Parser throughput in MB/s and peak allocations over a corpus of recorded listing pages
+and over a page nested deeper than any ss.com listing, where the tag stack handling shows.
+"""
+import os
+import tracemalloc
+
+import pytest
+
+import ssverification
+import utils
+from listings import listing
+
+pytest.importorskip('pytest_benchmark')
+
+backends = [utils.MyHTMLParser, pytest.param(utils.LxmlHTMLParser, marks=pytest.mark.skipif(
+    utils.lxml is None, reason='lxml is not installed'))]
+
+
+def corpus(folder):
+    texts = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.html'):
+            with open(os.path.join(folder, name), encoding='utf-8') as f:
+                texts.append(f.read())
+    return texts
+
+
+def nested(depth=300):
+    page = listing(1, 1)
+    return page.replace('<table>', '<div>' * depth + '<table>').replace('</table>', '</table>' + '</div>' * depth)
+
+
+def measure(benchmark, monkeypatch, parser, texts):
+    monkeypatch.setattr(ssverification, 'Parser', parser)
+
+    def parse():
+        return [ssverification.parse_page(text) for text in texts]
+
+    benchmark.pedantic(parse, rounds=5, iterations=1)
+    size = sum(len(text.encode()) for text in texts)
+    if benchmark.stats:
+        # No stats with --benchmark-disable.
+        benchmark.extra_info['mb_per_s'] = size / benchmark.stats.stats.mean / 1e6
+    tracemalloc.start()
+    try:
+        parse()
+        benchmark.extra_info['peak_kib'] = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('parser', backends)
+def test_recorded_pages(benchmark, monkeypatch, recorded, parser):
+    measure(benchmark, monkeypatch, parser, corpus(recorded(3000)))
+
+
+@pytest.mark.parametrize('parser', backends)
+def test_deeply_nested_page(benchmark, monkeypatch, parser):
+    measure(benchmark, monkeypatch, parser, [nested()] * 20)
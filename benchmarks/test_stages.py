@@ -0,0 +1,106 @@
+"""
+Per-stage benchmarks of a verification cycle, offline: pages come from a replay folder, the database is mongomock.
+Run with python -m pytest benchmarks, compare runs with --benchmark-autosave and --benchmark-compare.
+mongomock scans its documents for every update, the largest size of the database stages needs BENCHMARK_MONGO_URL,
+a throwaway server whose ss_ads database is dropped afterwards.
+"""
+import os
+
+import pytest
+
+import ssverification
+
+pytest.importorskip('pytest_benchmark')
+
+sizes = [300, 3000, 30000]
+db_sizes = sizes if os.environ.get('BENCHMARK_MONGO_URL') else sizes[:2]
+
+
+def run(benchmark, function, *args, setup=None):
+    if setup:
+        return benchmark.pedantic(function, setup=lambda: (setup(), {}), rounds=3, iterations=1)
+    return benchmark.pedantic(function, args, rounds=3, iterations=1)
+
+
+@pytest.mark.parametrize('ads', sizes)
+def test_parse(benchmark, recorded, replay, ads):
+    replay(ads)
+    session = ssverification.session
+    texts = [session._get(url).text for url in session.pages]
+    benchmark.extra_info['bytes'] = sum(len(t.encode()) for t in texts)
+    run(benchmark, lambda: [ssverification.parse_page(text) for text in texts])
+
+
+@pytest.mark.parametrize('ads', sizes)
+def test_crawl(benchmark, replay, ads):
+    sites = replay(ads)
+    rows = run(benchmark, lambda: list(ssverification.request_ss_records(sites)))
+    assert len(rows) == ads
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4])
+def test_parse_workers(benchmark, monkeypatch, replay, workers):
+    """ Crawl throughput by parse.workers, read it against the cores of the machine. """
+    sites = replay(sizes[-1])
+    monkeypatch.setitem(ssverification.config, 'parse.workers', workers)
+    rows = run(benchmark, lambda: list(ssverification.request_ss_records(sites)))
+    benchmark.extra_info['cores'] = os.cpu_count()
+    if benchmark.stats:
+        # No stats with --benchmark-disable.
+        benchmark.extra_info['pages_per_s'] = len(ssverification.session.pages) / benchmark.stats.stats.mean
+    assert len(rows) == sizes[-1]
+
+
+@pytest.mark.parametrize('ads', sizes)
+def test_build_model(benchmark, replay, ads):
+    rows = list(ssverification.request_ss_records(replay(ads)))
+    index = run(benchmark, ssverification.build_model, rows)
+    assert len(index) == ads
+
+
+@pytest.mark.parametrize('ads', sizes)
+def test_compare(benchmark, stored, verification, ads):
+    index, documents = stored(ads)
+
+    def setup():
+        verification()
+        return documents, index, set()
+
+    run(benchmark, ssverification.verify_rows, setup=setup)
+    assert ssverification.events.count('old_') == len(documents[::10])
+
+
+@pytest.mark.parametrize('ads', db_sizes)
+def test_bulk_write(benchmark, stored, verification, ads):
+    index, documents = stored(ads)
+
+    def setup():
+        db = verification()
+        collection = db[ssverification.ss_ad_collection]
+        collection.delete_many({})
+        collection.insert_many([dict(d) for d in documents])
+        ssverification.verify_rows(documents, index, set())
+        return ()
+
+    def flush():
+        ssverification.writer.flush()
+        ssverification.history.flush()
+
+    run(benchmark, flush, setup=setup)
+
+
+@pytest.mark.parametrize('ads', db_sizes)
+def test_cycle(benchmark, monkeypatch, stored, mongo, ads):
+    index, documents = stored(ads)
+    monkeypatch.setitem(ssverification.config, 'events.file', None)
+    monkeypatch.setitem(ssverification.config, 'metrics.file', 'metrics.json')
+    # The geodata cache outlives a cycle, it must not keep the database of an earlier benchmark.
+    monkeypatch.setattr(ssverification, 'geo', None)
+
+    def setup():
+        collection = mongo.ss_ads[ssverification.ss_ad_collection]
+        collection.delete_many({})
+        collection.insert_many([dict(d) for d in documents])
+        return mongo, list(ssverification.config['sites'])
+
+    run(benchmark, ssverification.run_cycle, setup=setup)
@@ -0,0 +1,14 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, root)
+
+# ssverification reads config.json from the working directory and writes its logs and page cache there.
+workdir = tempfile.mkdtemp(prefix='ssverification-')
+shutil.copy(os.path.join(root, 'config.json'), workdir)
+os.chdir(workdir)
+atexit.register(shutil.rmtree, workdir, True)
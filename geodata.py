@@ -0,0 +1,135 @@
+import datetime
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from requests import RequestException
+
+from utils import RequestError, google_geocode
+
+logger = logging.getLogger(__name__)
+
+space_pattern = re.compile(r'\s+')
+
+
+def address_key(address):
+    """ One key for the spellings of an address, "Brīvības  iela 1," and "brīvības iela 1" give "brīvības iela 1". """
+    address = unicodedata.normalize('NFKC', address).casefold()
+    return space_pattern.sub(' ', address).strip(' ,.')
+
+
+def google_geocoder(key='', components='locality:riga|country:LV', language='ru', timeout=(5, 30)):
+    return lambda address: google_geocode(address, components, language, key, timeout)
+
+
+class GeoCache:
+    """
+    Geocoding results by address key: an in-memory LRU in front of the geodata collection,
+    the geocoder is called only for addresses found in neither.
+    Empty results are cached too, failed geocoder calls are not.
+    Documents stored before the cache get the keys of their address and address_lv in ensure_indexes,
+    their geodata is the whole document when it has no results field.
+    """
+
+    def __init__(self, collection, geocoder=None, max_entries=10000):
+        self.collection = collection
+        self.geocoder = geocoder
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.geocoded = 0
+
+    def ensure_indexes(self):
+        # Sparse, documents stored before the cache have no key until they are backfilled.
+        self.collection.create_index([('key', pymongo.ASCENDING)], unique=True, sparse=True)
+        self.collection.create_index([('aliases', pymongo.ASCENDING)], sparse=True)
+        self.backfill_keys()
+
+    def backfill_keys(self, batch_size=1000):
+        """
+        Keys the documents stored before the cache by address_lv, or address, the other spelling becomes an alias.
+        Documents of an address keyed already by another document are left without a key.
+        """
+        operations = []
+        for document in self.collection.find({'key': {'$exists': False}}, {'address': 1, 'address_lv': 1}):
+            keys = []
+            for field in ['address_lv', 'address']:
+                if isinstance(document.get(field), str) and address_key(document[field]) not in keys:
+                    keys.append(address_key(document[field]))
+            if keys:
+                operations.append(UpdateOne({'_id': document['_id']}, {'$set': {'key': keys[0], 'aliases': keys[1:]}}))
+        duplicates = 0
+        for i in range(0, len(operations), batch_size):
+            try:
+                self.collection.bulk_write(operations[i:i + batch_size], ordered=False)
+            except BulkWriteError as e:
+                duplicates += len(e.details['writeErrors'])
+        if duplicates:
+            logger.warning("%s geodata documents duplicate a keyed address.", duplicates)
+        if len(operations) > duplicates:
+            logger.info("Keyed %s geodata documents.", len(operations) - duplicates)
+
+    def remember(self, key, results):
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, address):
+        return self.lookup([address]).get(address_key(address))
+
+    def lookup(self, addresses):
+        """
+        Returns {address key: results} for the addresses that could be resolved,
+        with one query for all addresses missing in memory and one insert for all newly geocoded ones.
+        """
+        found = {}
+        missing = []
+        spellings = {address_key(a): a for a in addresses}
+        for key in spellings:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+            else:
+                missing.append(key)
+        if not missing:
+            return found
+
+        query = {'$or': [{'key': {'$in': missing}}, {'aliases': {'$in': missing}}]}
+        for document in self.collection.find(query, {'_id': 0}):
+            results = document['results'] if 'results' in document else document
+            for key in [document['key']] + (document['aliases'] if 'aliases' in document else []):
+                if key in spellings:
+                    found[key] = results
+                    self.remember(key, results)
+
+        documents = []
+        for key in missing:
+            if key in found or not self.geocoder:
+                continue
+            try:
+                results = self.geocoder(spellings[key])
+            except (RequestError, RequestException, KeyError) as e:
+                logger.error(Exception('Not geocoded', spellings[key], e))
+                continue
+            found[key] = results
+            self.remember(key, results)
+            documents.append({'key': key, 'address': spellings[key], 'results': results, 'date': datetime.datetime.utcnow()})
+        if documents:
+            self.geocoded += len(documents)
+            try:
+                self.collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Geocoded by another worker in the meantime.
+                logger.debug(e.details['writeErrors'])
+        return found
+
+    def unknown(self, addresses):
+        """ Addresses which have no geodata and could not be geocoded. """
+        found = self.lookup(addresses)
+        return sorted({a for a in addresses if address_key(a) not in found})
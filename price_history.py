@@ -0,0 +1,103 @@
+import datetime
+import logging
+import statistics
+
+import pymongo
+from pymongo import InsertOne
+
+logger = logging.getLogger(__name__)
+
+# One document per price change: {ad_id, url, district, date, old_price, price, price_m2}.
+indexes = [
+    [('ad_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+    [('district', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+    [('date', pymongo.ASCENDING)],
+]
+
+
+def district(url):
+    """ "real-estate/flats/riga/centre/abcde.html" -> "real-estate/flats/riga/centre". """
+    return url.rsplit('/', 1)[0]
+
+
+def ensure_indexes(collection):
+    for keys in indexes:
+        name = collection.create_index(keys)
+        logger.debug("Index %s is in place.", name)
+
+
+def price_point(ad_id, url, old_price, price, price_m2=None, date=None):
+    return {'ad_id': ad_id, 'url': url, 'district': district(url), 'date': date or datetime.datetime.utcnow(),
+            'old_price': old_price, 'price': price, 'price_m2': price_m2}
+
+
+def history(collection, ad_id):
+    """ Price changes of one ad, oldest first. """
+    return list(collection.find({'ad_id': ad_id}, {'_id': 0}).sort('date', pymongo.ASCENDING))
+
+
+def drops(collection, district_name, since):
+    """ Price drops of the ads in a district since the given date, newest first. """
+    return [p for p in collection.find({'district': district_name, 'date': {'$gte': since}}, {'_id': 0})
+            .sort('date', pymongo.DESCENDING)
+            if isinstance(p['price'], (int, float)) and isinstance(p['old_price'], (int, float))
+            and p['price'] < p['old_price']]
+
+
+def median_price_m2(collection, since, district_name=None):
+    """
+    {(district, day): median price_m2} over the price changes recorded since the given date.
+    Only the ads whose price changed that day are counted, not all listed ads, and a migrated change
+    has a price_m2 only when it is the latest one of its ad.
+    """
+    query = {'date': {'$gte': since}}
+    if district_name:
+        query['district'] = district_name
+    days = {}
+    for p in collection.find(query, {'_id': 0, 'district': 1, 'date': 1, 'price_m2': 1}):
+        if isinstance(p.get('price_m2'), (int, float)):
+            days.setdefault((p['district'], p['date'].date()), []).append(p['price_m2'])
+    return {key: statistics.median(values) for key, values in sorted(days.items())}
+
+
+def write_batch(ads, collection, operations, sources):
+    """ Inserts a batch of price points and removes its old price records, a rerun does not insert them again. """
+    collection.bulk_write(operations, ordered=False)
+    ads.delete_many({'_id': {'$in': sources}})
+    return len(sources)
+
+
+def migrate(ads, collection, normalize=lambda key, value: value, batch_size=1000):
+    """
+    Moves the {'kind': 'old_price'} records of the ads collection into the price history.
+    The new price of a change is the old price of the next one, or the current price of the ad for the last one.
+    Returns the number of migrated records.
+    """
+    old_prices = {}
+    for record in ads.find({'kind': 'old_price'}).sort('date', pymongo.ASCENDING):
+        old_prices.setdefault(record['ad_id'], []).append(record)
+
+    migrated = 0
+    operations = []
+    sources = []
+    for ad in ads.find({'_id': {'$in': list(old_prices)}}, {'url': 1, 'price': 1, 'price_m2': 1}):
+        records = old_prices.pop(ad['_id'])
+        prices = [normalize('price', r['price']) for r in records] + [normalize('price', ad.get('price'))]
+        for i, record in enumerate(records):
+            # Only the latest change is known to lead to the current price_m2.
+            price_m2 = normalize('price_m2', ad.get('price_m2')) if i == len(records) - 1 else None
+            operations.append(InsertOne(price_point(ad['_id'], ad['url'], prices[i], prices[i + 1], price_m2,
+                                                    record['date'])))
+            sources.append(record['_id'])
+        if len(operations) >= batch_size:
+            migrated += write_batch(ads, collection, operations, sources)
+            operations = []
+            sources = []
+    if operations:
+        migrated += write_batch(ads, collection, operations, sources)
+    if old_prices:
+        logger.warning("Old price records of %s removed ads were left in place.", len(old_prices))
+    if not old_prices and 'ad_id_1_date_1' in ads.index_information():
+        # The index served the old price records only.
+        ads.drop_index('ad_id_1_date_1')
+    return migrated
@@ -1,13 +1,34 @@
 #!/usr/bin/env python3
+import argparse
 import datetime
+import hashlib
+import json
 import os
+import re
+import socket
+import sys
 
 import logging
 import pymongo
 import time
 from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Semaphore
+from urllib.parse import urljoin, urlparse
 
-from utils import json_from_file, MyHTMLParser, json_to_file, _get
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import geodata
+import price_history
+from requests import RequestException
+from utils import json_from_file, html_parser, json_to_file, _session, PageCache, Metrics, ReplaySession, \
+    RequestError
 
 config_file_name = 'config.json'
 config = {}
@@ -20,10 +41,39 @@ except RuntimeError as e:
 
 ss_ad_collection = config['ss_ad_collection']
 geodata_collection = config['geodata_collection']
+price_history_collection = config['price_history_collection'] if 'price_history_collection' in config \
+    else 'price_history'
 
 if not os.path.exists('requests'):
     os.makedirs('requests')
 
+def create_session(record_folder=None, replay_folder=None):
+    options = dict(pool_size=config['http.pool.size'] if 'http.pool.size' in config else 10,
+                   retries=config['http.retries'] if 'http.retries' in config else 3,
+                   backoff=config['http.backoff'] if 'http.backoff' in config else 0.5,
+                   timeout=(config['http.timeout.connect'] if 'http.timeout.connect' in config else 5,
+                            config['http.timeout.read'] if 'http.timeout.read' in config else 30))
+    if replay_folder:
+        return ReplaySession(replay_folder, **options)
+    return _session(record_folder=record_folder, **options)
+
+
+def create_client(url):
+    """ mongomock:// urls give an in-memory stand-in for offline runs. """
+    if url.startswith('mongomock://'):
+        import mongomock
+        return mongomock.MongoClient()
+    return pymongo.MongoClient(url)
+
+
+session = create_session()
+
+metrics = Metrics(config['logging.name'])
+
+cache = None
+if 'cache.size' in config and config['cache.size'] > 0:
+    cache = PageCache(config['cache.folder'] if 'cache.folder' in config else 'requests/', config['cache.size'])
+
 formatter = logging.Formatter(config['logging.format'])
 # Create handlers
 c_handler = logging.StreamHandler()
@@ -42,30 +92,45 @@ logging.basicConfig(format=config["logging.format"], handlers=[c_handler, f_hand
 logger = logging.getLogger(config["logging.name"])
 logger.setLevel(logging_level)
 
+columnar = 'verify.mode' in config and config['verify.mode'] == 'columnar'
+if columnar and np is None:
+    logger.warning("numpy is not installed, falling back to row by row verification.")
+    columnar = False
+
+
+page_pattern = re.compile(r'page(\d+)\.html$')
 
-def extract_pages(data):
-    pages = []
-    for line in data:
-        if isinstance(line, tuple) and line[0] == 'a' and len(line[1]) == 4 and line[1][0][1] == 'nav_id':
-            pages.append(line[1][3][1])
-    return pages, pages.pop(0)
 
+def page_urls(site, page_links):
+    """ Urls of pages 2..N of a site, N is the highest page number among the pagination links of its first page. """
+    numbers = [int(m.group(1)) for m in (page_pattern.search(link) for link in page_links) if m]
+    return [urljoin(site, 'page%d.html' % p) for p in range(2, max(numbers, default=1) + 1)]
 
-def is_item(item):
-    return len(item) >= 3 and item[0] == 'td' and len(item[1]) > 0 and len(item[1][0]) > 1 and item[1][0][1] == config[
-        "sscom.class"]
 
+def is_seen(rows, seen):
+    """ A page is seen when every row on it is byte-identical to a row of the last crawl, a changed price is not. """
+    return bool(seen) and bool(rows) and all(fingerprint(items) in seen for items in rows)
 
-def is_url(item):
-    return len(item) >= 2 and item[0] == 'a' and len(item[1]) > 2 and len(item[1][2]) > 1 and item[1][2][1] == config[
-        "sscom.class.url"]
+
+# Row fingerprints of every site since its last full crawl, for crawl.early_stop.
+seen_rows = {}
+# Crawls of every site since its last full crawl.
+crawls_since_full = {}
+
+
+def can_stop_early(site):
+    """
+    With crawl.early_stop a site is crawled only down to the first page with nothing new or changed,
+    so changes further down and removed ads are noticed only by the full crawl every crawl.full_every crawls.
+    """
+    full_every = config['crawl.full_every'] if 'crawl.full_every' in config else 12
+    return is_property('crawl.early_stop') and site in seen_rows and crawls_since_full.get(site, 0) + 1 < full_every
 
 
 def generate_report(ads={}, new_ads=[], new_address=[]):
     try:
-        for a in ads:
-            for i in ads[a]['items']:
-                print("{0:>30} {1:7}".format(a, str(i)))
+        for a in ads.values():
+            print("{0:>30} {1:7}".format(a.address, str(a)))
         print("______________________________________________________")
         print("_____________  New Records  __________________________")
         for a in new_ads:
@@ -83,44 +148,287 @@ def generate_report(ads={}, new_ads=[], new_address=[]):
         logger.error(e)
 
 
-def uload_new_records(new_ads):
+def uload_new_records(new_ads, date=None):
+    date = date or datetime.datetime.utcnow()
     try:
-        db[ss_ad_collection].insert_many(new_ads)
+        db[ss_ad_collection].insert_many([a.to_document(date) for a in new_ads])
     except RuntimeError as e:
         logger.error(e)
 
 
-def request_ss_records():
-    data = []
+class HostLimiter:
+    """Caps concurrent requests per host and spaces their starts by a politeness delay."""
+
+    def __init__(self, concurrency=1, delay=0):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.lock = Lock()
+        self.semaphores = {}
+        self.next_slot = {}
+
+    @contextmanager
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = Semaphore(self.concurrency)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            with self.lock:
+                now = time.monotonic()
+                slot = max(now, self.next_slot.get(host, now))
+                self.next_slot[host] = slot + self.delay
+            if slot > now:
+                time.sleep(slot - now)
+            yield
+
+
+parser_config = {'valid_tags': ['tr', 'td', 'a', 'br', 'b'], 'skip_tags': ['b']}
+Parser = html_parser(config['parser.backend'] if 'parser.backend' in config else 'html.parser')
+
+
+def parse_page(chunks):
+    """ Parses a listing page, given as text or as text chunks, into its rows and pagination links. """
+    if isinstance(chunks, str):
+        chunks = [chunks]
+    extractor = RowExtractor()
+    rows = list(extractor.rows(Parser(parser_config).feed_and_iterate(chunks)))
+    return rows, extractor.pages
+
+
+def fetch_page(url, limiter, parse_pool=None):
+    parse = parse_page
+    if parse_pool:
+        # Parse in a worker process, only the compact rows come back.
+        parse = lambda text: parse_pool.submit(parse_page, text).result()
+
+    if not parse_pool:
+        # Parse while the body is still downloading, the fetch time includes parsing.
+        with limiter.acquire(url), metrics.timer('fetch', url=url):
+            r = session._get(url, stream=True, headers=cache.headers(url) if cache else None)
+            if r.encoding is None:
+                r.encoding = 'utf-8'
+            if cache:
+                return cache.stream(url, r, parse_page)
+            return parse_page(r.iter_content(chunk_size=16 * 1024, decode_unicode=True))
+
+    if not cache:
+        with limiter.acquire(url), metrics.timer('fetch', url=url):
+            text = session._get(url).text
+        with metrics.timer('parse'):
+            return parse(text)
+
+    headers = cache.headers(url)
+    with limiter.acquire(url), metrics.timer('fetch', url=url):
+        r = session._get(url, headers=headers)
+    with metrics.timer('parse'):
+        return cache.result(url, r, parse)
+
+
+def fetch_until_seen(site, urls, fetch, partial):
+    """ Fetches pages in order and stops after the first one whose rows were all seen in the last crawls. """
+    pages = []
+    for url in urls:
+        rows, page_links = fetch(url)
+        pages.append((rows, page_links))
+        if is_seen(rows, seen_rows.get(site)):
+            logger.info("Stopped at %s, older ads of %s were seen unchanged in the last crawls.", url, site)
+            partial.add(site)
+            break
+    return pages
+
+
+def results(future):
+    yield from future.result()
+
+
+def site_fetcher(site, fetch, partial):
+    """ A failed page leaves its site partial instead of failing the whole crawl. """
+    def fetch_site_page(url):
+        try:
+            return fetch(url)
+        except (RequestError, RequestException) as e:
+            logger.error("Failed to fetch %s: %s", url, e)
+            partial.add(site)
+            return [], []
+    return fetch_site_page
+
+
+def request_ss_records(sites, partial=None):
+    """
+    Yields raw listing rows of the site urls, site by site and page by page.
+    Sites which were not crawled to the last page, or had a page fail, are added to partial.
+    """
+    partial = set() if partial is None else partial
+    early_stop = {site for site in sites if can_stop_early(site)}
+    workers = config['crawl.workers'] if 'crawl.workers' in config else 1
+    limiter = HostLimiter(config['crawl.host.concurrency'] if 'crawl.host.concurrency' in config else workers,
+                          config['crawl.delay'] if 'crawl.delay' in config else 0)
+    parse_workers = config['parse.workers'] if 'parse.workers' in config else 1
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None
+    # Every parse keeps a download thread waiting for it.
+    workers = max(workers, parse_workers)
+    started = time.monotonic()
+    pages_count = 0
+    fetchers = {site: site_fetcher(site, lambda url: fetch_page(url, limiter, parse_pool), partial) for site in sites}
+    done = set()
     try:
-        for url in config["sites"]:
-            logger.info(f"Looking for new records in {url}")
-            parser_config = {'valid_tags': ['tr', 'td', 'a', 'br', 'b'], 'skip_tags': ['b']}
-            page = MyHTMLParser(parser_config).feed_and_return(_get(url).text)
-            pages, last = extract_pages(page.data)
-            data += page.data
-            pages_max = last.split('page')[1].split('.')[0]
-
-            for p in range(2, int(pages_max)+1):
-                _url = f"{config['sscom.url']}{last.replace(pages_max, str(p))}"
-                logger.debug(f"Looking for new records in rest of pages {_url}")
-                data += MyHTMLParser(parser_config).feed_and_return(_get(_url).text).data
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for url in sites:
+                logger.info(f"Looking for new records in {url}")
+            first_pages = list(pool.map(lambda url: fetchers[url](url), sites))
+
+            # Submit every remaining page up front, then merge site by site and page by page,
+            # so the result does not depend on the order in which downloads complete.
+            rest_pages = []
+            for site, (rows, page_links) in zip(sites, first_pages):
+                urls = page_urls(site, page_links)
+                for _url in urls:
+                    logger.debug(f"Looking for new records in rest of pages {_url}")
+                if site not in early_stop:
+                    rest_pages.append(pool.map(fetchers[site], urls))
+                elif is_seen(rows, seen_rows.get(site)):
+                    logger.info("Stopped at %s, older ads were seen unchanged in the last crawls.", site)
+                    partial.add(site)
+                    rest_pages.append([])
+                else:
+                    # Sequential within the site, sites still run in parallel.
+                    rest_pages.append(results(pool.submit(fetch_until_seen, site, urls, fetchers[site], partial)))
+
+            remember = is_property('crawl.early_stop')
+            for site, (rows, page_links), rest in zip(sites, first_pages, rest_pages):
+                seen = {fingerprint(items) for items in rows} if remember else set()
+                yield from rows
+                pages_count += 1
+                for rows, page_links in rest:
+                    if remember:
+                        seen.update(fingerprint(items) for items in rows)
+                    yield from rows
+                    pages_count += 1
+                if site in partial:
+                    # Bounded, a full crawl every crawl.full_every crawls starts the set over.
+                    seen_rows[site] = seen | seen_rows.get(site, set())
+                    crawls_since_full[site] = crawls_since_full.get(site, 0) + 1
+                else:
+                    seen_rows[site] = seen
+                    crawls_since_full[site] = 0
+                done.add(site)
     except RuntimeError as e:
-        logger.debug(e)
-    return data
+        logger.error(e)
+        partial.update(site for site in sites if site not in done)
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+    logger.info("Fetched %s pages in %.2f seconds.", pages_count, time.monotonic() - started)
+    metrics.observe('crawl', time.monotonic() - started)
+    metrics.count('pages', pages_count)
+    if cache:
+        logger.info("Reused %s unchanged pages.", cache.hits)
+        metrics.count('pages.unchanged', cache.hits)
+        cache.hits = 0
+        cache.save()
+    stats = session.stats(reset=True)
+    metrics.count('http.requests', stats['requests'])
+    metrics.count('http.connections', stats['connections'])
+    logger.info("HTTP requests %s, connections %s, reused %s, latency avg %.3fs max %.3fs.", stats['requests'],
+                stats['connections'], stats['reused'], stats['latency.avg'], stats['latency.max'])
+
+
+def fingerprint(items):
+    return hashlib.sha1('\t'.join(items).encode()).hexdigest()
+
+
+row_layouts = {
+    6: (['url', 'address', 'm2', 'level', 'price_m2', 'price'], {'type': config['house.marker']}),
+    8: (['url', 'address', 'rooms', 'm2', 'level', 'type', 'price_m2', 'price'], {}),
+}
+
+
+number_pattern = re.compile(r'\d+(?:[.,]\d+)*')
+separator_pattern = re.compile(r'[.,]')
+level_pattern = re.compile(r'(\d+)\s*/\s*(\d+)')
+
+
+def to_number(value):
+    """
+    "125 000 €" -> 125000, "65,000 €" -> 65000, "1.250.000 €" -> 1250000, "1,234.5" -> 1234.5,
+    "45.5" -> 45.5, "45,5" -> 45.5; a comma or dot followed by exactly three digits separates thousands,
+    otherwise the last one is the decimal point.
+    Values without a number are returned as they are.
+    """
+    if not isinstance(value, str):
+        return value
+    match = number_pattern.search(value.replace(' ', '').replace('\xa0', ''))
+    if not match:
+        return value
+    groups = separator_pattern.split(match.group())
+    if len(groups) > 1 and len(groups[-1]) != 3:
+        number = float(''.join(groups[:-1]) + '.' + groups[-1])
+    else:
+        number = float(''.join(groups))
+    return int(number) if number.is_integer() else number
+
+
+def to_level(value):
+    """ "3/5" -> [3, 5], a single number for houses. """
+    if isinstance(value, str):
+        match = level_pattern.search(value)
+        if match:
+            return [int(match.group(1)), int(match.group(2))]
+    elif isinstance(value, tuple):
+        return list(value)
+    return to_number(value)
+
+
+normalizers = {'price': to_number, 'price_m2': to_number, 'm2': to_number, 'rooms': to_number, 'level': to_level}
+
+
+def normalize(key, value):
+    if key in normalizers:
+        return normalizers[key](value)
+    return value
+
 
+class RemoteAd:
+    """
+    Ad as listed on ss.com. Columns missing from its layout are left unset and read as KeyError,
+    the crawl date is added only when the ad is turned into a Mongo document.
+    """
+    __slots__ = ('url', 'address', 'rooms', 'm2', 'level', 'type', 'price_m2', 'price', 'fingerprint')
 
-def build_db_record(items):
-    a = {}
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def fields(self):
+        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+    def to_document(self, date):
+        document = self.fields()
+        document['date'] = date
+        return document
+
+    def __repr__(self):
+        return "RemoteAd(%s)" % self.fields()
+
+
+def build_db_record(items, layouts=row_layouts):
+    a = RemoteAd()
     try:
-        a = {'url': "/".join(items[0].split('/')[3:]), 'address': items[1],
-             'date': datetime.datetime.utcnow()}
-        if len(items) == 6:
-            a.update({'m2': items[2], 'level': items[3], 'type': config['house.marker'],
-                      'price_m2': items[4], 'price': items[5]})
-        elif len(items) == 8:
-            a.update({'rooms': items[2], 'm2': items[3], 'level': items[4], 'type': items[5],
-                      'price_m2': items[6], 'price': items[7]})
+        a.url = "/".join(items[0].split('/')[3:])
+        a.address = sys.intern(items[1])
+        a.fingerprint = fingerprint(items)
+        if len(items) in layouts:
+            columns, constants = layouts[len(items)]
+            for key, value in zip(columns[2:], items[2:]):
+                setattr(a, key, sys.intern(value) if key == 'type' else normalize(key, value))
+            for key, value in constants.items():
+                setattr(a, key, value)
     except RuntimeError as e:
         logger.debug(e)
     return a
@@ -130,86 +438,223 @@ def is_property(param: str) -> bool:
     return param in config and config[param]
 
 
-def to_buffer(buffer, d):
-    if is_url(d):
-        buffer.append(d[1][3][1])
-    elif is_item(d):
-        buffer.append(d[len(d) - 1])
+class RowExtractor:
+    """
+    Single pass over parsed (tag, attrs, text...) tuples: collects the url link and the item cells
+    of a listing row and returns them once the row ends. Pagination links are collected into pages.
+    """
+
+    def __init__(self):
+        self.item_class = config["sscom.class"]
+        self.url_class = config["sscom.class.url"]
+        self.buffer = []
+        self.pages = []
+
+    def feed(self, d):
+        """ Returns the finished row cells when d closes a row, otherwise None. """
+        tag, attrs = d[0], d[1]
+        if tag == 'a':
+            if len(attrs) > 2 and len(attrs[2]) > 1 and attrs[2][1] == self.url_class:
+                self.buffer.append(attrs[3][1])
+                return None
+            if len(attrs) == 4 and attrs[0][1] == 'nav_id':
+                self.pages.append(attrs[3][1])
+        elif tag == 'td':
+            if len(d) >= 3 and attrs and len(attrs[0]) > 1 and attrs[0][1] == self.item_class:
+                self.buffer.append(d[-1])
+                return None
+        return self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return None
+        items = self.buffer
+        self.buffer = []
+        return items
+
+    def rows(self, data):
+        for d in data:
+            items = self.feed(d)
+            if items:
+                yield items
+        items = self.flush()
+        if items:
+            yield items
+
+
+def to_index(index, a):
+    index[a.url] = a
+
+
+def build_model(rows):
+    index = {}
+    seconds = 0
+    # rows may be a crawl in progress, only the model building itself is timed.
+    for items in rows:
+        started = time.monotonic()
+        to_index(index, build_db_record(items))
+        seconds += time.monotonic() - started
+    metrics.observe('build_model', seconds)
+    metrics.count('ads.crawled', len(index))
+    return index
+
+
+def address_index(index):
+    """ {address: [crawled ads]}, for the stored ads whose url is no longer listed. """
+    by_address = {}
+    for a in index.values():
+        by_address.setdefault(a.address, []).append(a)
+    return by_address
+
+
+def ad_name(url):
+    """ "real-estate/flats/riga/centre/abcde.html" -> "abcde.html", the ad id which stays when it moves sections. """
+    return url.rsplit('/', 1)[-1]
+
+
+def find_by_url(url, addresses, index, by_address=None):
+    """
+    The crawled ad listed under the url of a stored ad, the url alone identifies it.
+    When the url is not listed, the ad may have moved to another section: same ad id at one of its addresses.
+    """
+    a = index.get(url)
+    if a:
+        return a
+    if by_address:
+        for address in addresses:
+            for a in by_address.get(address, []):
+                if ad_name(a.url) == ad_name(url):
+                    return a
+    return None
 
 
-def to_ads(ads, a):
-    try:
-        _addr = ads[a['address']]
-        _addr['items'].append(a)
-    except:
-        ads[a['address']] = {'items': [a]}
-
-
-def build_model(data):
-    ads = {}
-    buffer = []
-    i = 0
-    while i <= len(data) - 1:
-        d = data[i]
-        if is_url(d) or is_item(d):
-            to_buffer(buffer, d)
-        elif buffer:
-            a = build_db_record(buffer)
-            buffer = []
-
-            to_ads(ads, a)
-
-        i += 1
-    return ads
-
-
-def find_by_url(url, address, ads):
-    for a in ads:
-        if a == address:
-            for i in ads[a]['items']:
-                if i['url'] == url:
-                    return i
-            break
-    return None
+class BulkWriter:
+    """
+    Collects inserts and field updates for one collection and sends them as bulk_write batches.
+    Updates of several fields of the same document are merged into a single $set.
+    """
+
+    def __init__(self, collection, batch_size=1000, ordered=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.inserts = []
+        self.updates = {}
+
+    def insert(self, document):
+        self.inserts.append(document)
+        self.flush_if_full()
+
+    def set(self, _id, key, value):
+        self.updates.setdefault(_id, {})[key] = value
+        self.flush_if_full()
+
+    def flush_if_full(self):
+        if len(self.inserts) + len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        operations = [(InsertOne(d), ('Not inserted', d)) for d in self.inserts]
+        operations += [(UpdateOne({'_id': _id}, {'$set': fields}), ('Not updated record', _id))
+                       for _id, fields in self.updates.items()]
+        self.inserts = []
+        self.updates = {}
+        for i in range(0, len(operations), self.batch_size):
+            self.write(operations[i:i + self.batch_size])
+
+    def write(self, batch):
+        ids = [target for message, target in (d for op, d in batch) if message == 'Not updated record']
+        try:
+            result = self.collection.bulk_write([op for op, d in batch], ordered=self.ordered)
+            matched = result.matched_count
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                message, target = batch[error['index']][1]
+                logger.error(Exception(message, target, error['errmsg']))
+            matched = e.details['nMatched']
+        if matched < len(ids):
+            self.report_not_matched(ids)
+
+    def report_not_matched(self, ids):
+        existing = {d['_id'] for d in self.collection.find({'_id': {'$in': ids}}, {'_id': 1})}
+        for _id in ids:
+            if _id not in existing:
+                logger.error(Exception('Not updated record', _id))
+
+
+class EventLog:
+    """
+    Append-only log of compact change events, written in batches as newline-delimited json
+    and/or into a capped collection, so downstream tools can follow it while the cycle runs.
+    """
+
+    def __init__(self, file_name=None, collection=None, batch_size=1000):
+        self.file_name = file_name
+        self.collection = collection
+        self.batch_size = batch_size
+        self.buffer = []
+        self.counts = {}
+
+    def append(self, kind, ad, key=None, old=None, new=None):
+        event = {'kind': kind, 'ad_id': ad['_id'], 'url': ad['url'], 'date': datetime.datetime.utcnow()}
+        if key:
+            event.update(key=key, old=old, new=new)
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.buffer.append(event)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def count(self, prefix):
+        return sum(n for kind, n in self.counts.items() if kind.startswith(prefix))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        events = self.buffer
+        self.buffer = []
+        if self.file_name:
+            with open(self.file_name, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(e, ensure_ascii=False, default=str) + '\n' for e in events)
+        if self.collection is not None:
+            try:
+                self.collection.insert_many(events, ordered=False)
+            except PyMongoError as e:
+                logger.error(Exception('Events not inserted', len(events), e))
+
+
+def events_collection(db):
+    """ The capped collection of change events, created on first use. """
+    if 'events.collection' not in config or not config['events.collection']:
+        return None
+    name = config['events.collection']
+    if name not in db.list_collection_names():
+        db.create_collection(name, capped=True, size=config['events.size'] if 'events.size' in config else 2 ** 26)
+    return db[name]
 
 
 def resolve_diff_key(ad_old, ad_new, key):
-    global db, resolved
-    print('old_' + key, ad_old[key], ad_new[key])
-    resolved.append({'kind': 'old_' + key, 'old': ad_old, 'new': ad_new})
-    try:
-        old_price_record = {'kind': 'old_' + key, 'ad_id': ObjectId(ad_old['_id']), 'price': ad_old['price'],
-                            'date': datetime.datetime.utcnow()}
-        # del ad_old['_id']
-        # result = db[ss_ad_collection].insert_one(ad_old)
-        result = db[ss_ad_collection].insert_one(old_price_record)
-        if not result.inserted_id:
-            raise Exception('Not inserted', old_price_record)
-        result = db[ss_ad_collection].update_one({'_id': ad_old['_id']}, {'$set': {key: ad_new[key]}})
-        if not result.matched_count:
-            raise Exception('Not updated record', ad_old['_id'])
-    except Exception as e:
-        logger.error(e)
+    global writer, history, events
+    logger.debug("old_%s %s %s", key, ad_old[key], ad_new[key])
+    events.append('old_' + key, ad_old, key, ad_old[key], ad_new[key])
+    history.insert(price_history.price_point(ObjectId(ad_old['_id']), ad_old['url'], normalize(key, ad_old[key]),
+                                             ad_new[key], ad_new['price_m2'] if 'price_m2' in ad_new else None))
+    writer.set(ad_old['_id'], key, ad_new[key])
 
 
 def resolve_update_key(ad_old, ad_new, key):
-    global db, resolved
-    print('old_' + key, ad_old[key], ad_new[key])
-    resolved.append({'kind': 'old_' + key, 'old': ad_old, 'new': ad_new})
-    result = db[ss_ad_collection].update_one({'_id': ad_old['_id']}, {'$set': {key:ad_new[key]}})
-    if not result.matched_count:
-        raise Exception('Not updated record', ad_old['_id'])
+    global writer, events
+    logger.debug("old_%s %s %s", key, ad_old[key], ad_new[key])
+    events.append('old_' + key, ad_old, key, ad_old[key], ad_new[key])
+    writer.set(ad_old['_id'], key, ad_new[key])
 
 
 def resolve_rooms(ad_old, ad_new, key):
-    global db, resolved
+    global writer, events
     if ad_new[key] == 'Citi':
         return
-    print('old_' + key, ad_old[key], ad_new[key])
-    resolved.append({'kind': 'old_' + key, 'old': ad_old, 'new': ad_new})
-    result = db[ss_ad_collection].update_one({'_id': ad_old['_id']}, {'$set': {key:ad_new[key]}})
-    if not result.matched_count:
-        raise Exception('Not updated record', ad_old['_id'])
+    logger.debug("old_%s %s %s", key, ad_old[key], ad_new[key])
+    events.append('old_' + key, ad_old, key, ad_old[key], ad_new[key])
+    writer.set(ad_old['_id'], key, ad_new[key])
 
 
 def skip(*args, **kwargs): pass
@@ -223,7 +668,9 @@ mapping = {
     'price_m2': resolve_update_key,
     'm2': resolve_update_key,
     'level': resolve_update_key,
-    'rooms': resolve_rooms
+    'rooms': resolve_rooms,
+    'url': resolve_update_key,
+    'fingerprint': skip
 }
 
 
@@ -231,73 +678,449 @@ def get(d: dict, key: str) -> object:
     try:
         return d[key]
     except KeyError as e:
-        if key in ['_id', 'date', 'kind', 'address', 'address_lv', 'type', 'outdated', 'rooms']:
+        if key in ['_id', 'date', 'kind', 'address', 'address_lv', 'type', 'outdated', 'rooms', 'fingerprint']:
             return skip
         raise e
 
 
 def compare(my_ad, remote_ad):
     for key in my_ad.keys():
-        if get(my_ad, key) != get(remote_ad, key):
+        # Stored values may still be the raw scraped strings.
+        if normalize(key, get(my_ad, key)) != get(remote_ad, key):
             try:
-                get(mapping, key)(my_ad, remote_ad, key=key)
+                resolver = get(mapping, key)
+                resolver(my_ad, remote_ad, key=key)
+                if resolver is not skip:
+                    metrics.count('resolved', resolver=resolver.__name__, key=key)
             except KeyError as e:
                 logger.error('Key error:' + key)
-                not_exist_resolver.append({'kind': 'old_' + key, 'old': my_ad, 'new': remote_ad})
+                events.append('no_resolver', my_ad, key, my_ad[key], remote_ad[key] if key in remote_ad else None)
 
 
-def get_address(ad):
-    if 'address_lv' in ad:
-        return ad['address_lv']
-    if 'address' in ad:
-        return ad['address']
-    return None
+def get_addresses(ad):
+    return [ad[key] for key in ['address_lv', 'address'] if key in ad]
 
-def outdate(my_ad):
-    if 'outdated' in my_ad:
-        return
-    outdated.append(my_ad)
-    result = db[ss_ad_collection].update_one({'_id': my_ad['_id']}, {'$set': {'outdated': True}})
-    if not result.matched_count == 1:
-        logger.error("%s not updated properly.", my_ad['_id'])
 
+verified_fields = {key: 1 for key in ['url', 'address', 'address_lv', 'price', 'price_m2', 'm2', 'level', 'rooms',
+                                      'outdated', 'fingerprint']}
 
-while True:
-    resolved = []
-    not_exist_resolver = []
-    outdated = []
 
-    try:
-        myclient = pymongo.MongoClient(config["db.url"])
+def verify_rows(my_ads, remote_index, found, by_address=None):
+    for my_ad in my_ads:
+        remote_ad = find_by_url(my_ad['url'], get_addresses(my_ad), remote_index, by_address)
+        if remote_ad:
+            found.add(remote_ad.url)
+            # The listing row is unchanged since the last check, nothing to compare.
+            if get(my_ad, 'fingerprint') == remote_ad.fingerprint:
+                continue
+            compare(my_ad, remote_ad)
+            writer.set(my_ad['_id'], 'fingerprint', remote_ad.fingerprint)
+        else:
+            outdate(my_ad)
 
-        with myclient:
-            db = myclient.ss_ads
 
-            data = request_ss_records()
+class RemoteColumns:
+    """ Crawled ads as NumPy columns sorted by url, for joining chunks of stored ads in one go. """
 
-            remote_ads = build_model(data)
+    def __init__(self, remote_index):
+        self.ads = [remote_index[url] for url in sorted(remote_index)]
+        self.urls = np.array([a.url for a in self.ads], dtype=str)
+        self.fingerprints = np.array([a.fingerprint for a in self.ads], dtype=object)
 
-            my_ads = list(db[ss_ad_collection].find({'kind': 'ad'}))
 
-            for my_ad in my_ads:
-                remote_ad = find_by_url(my_ad['url'], get_address(my_ad), remote_ads)
-                if remote_ad:
-                    compare(my_ad, remote_ad)
-                else:
-                    outdate(my_ad)
+def verify_columnar(my_ads, columns, found, by_address=None):
+    """
+    Same outcome as verify_rows: masks pick the changed and the unlisted ads, only those reach the resolvers.
+    A changed price or area changes the fingerprint too.
+    """
+    if not len(columns.urls):
+        verify_rows(my_ads, {}, found, by_address)
+        return
 
-            for my_ad in resolved:
-                print(my_ad)
+    urls = np.array([ad['url'] for ad in my_ads], dtype=str)
+    pos = np.searchsorted(columns.urls, urls)
+    pos[pos == len(columns.urls)] = 0
+    matched = columns.urls[pos] == urls
+    changed = matched & (np.array([ad.get('fingerprint') for ad in my_ads], dtype=object) != columns.fingerprints[pos])
+    logger.debug("Changed %s, not listed %s of %s.", changed.sum(), (~matched).sum(), len(my_ads))
+
+    found.update(urls[matched].tolist())
+    for i in np.flatnonzero(changed):
+        remote_ad = columns.ads[pos[i]]
+        compare(my_ads[i], remote_ad)
+        writer.set(my_ads[i]['_id'], 'fingerprint', remote_ad.fingerprint)
+    # Moved to another section or gone, the address fallback decides.
+    verify_rows([my_ads[i] for i in np.flatnonzero(~matched)], {}, found, by_address)
+
+
+def stored_ads(collection, batch_size=1000, query=None):
+    """ Streams stored ads in chunks, with only the fields the verification uses. """
+    chunk = []
+    for ad in collection.find(dict({'kind': 'ad'}, **(query or {})), verified_fields, batch_size=batch_size):
+        chunk.append(ad)
+        if len(chunk) >= batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+indexes = [
+    ([('kind', pymongo.ASCENDING), ('url', pymongo.ASCENDING)], {}),
+    ([('outdated', pymongo.ASCENDING)], {'sparse': True}),
+]
+
+
+def ensure_indexes(collection):
+    for keys, options in indexes:
+        name = collection.create_index(keys, **options)
+        logger.debug("Index %s is in place.", name)
+
+
+def explain(collection, history_collection):
+    """ Prints query plans of the verification and price history queries and warns about collection scans. """
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    queries = {
+        'stored ads': collection.find({'kind': 'ad'}, verified_fields),
+        # A cycle over some of the sites, with leases or due intervals.
+        'stored ads of sites': collection.find({'kind': 'ad', 'url': {'$regex': scope_pattern(
+            [site_url(site) for site in config['sites'][:2]])}}, verified_fields),
+        'ad by id': collection.find({'_id': ObjectId()}),
+        'price history of ad': history_collection.find({'ad_id': ObjectId()}).sort('date'),
+        'prices in district': history_collection.find({'district': 'real-estate/flats/riga/centre',
+                                                       'date': {'$gte': since}}),
+        'prices since': history_collection.find({'date': {'$gte': since}}),
+    }
+    for name, cursor in queries.items():
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        print(name, plan)
+        if 'COLLSCAN' in str(plan):
+            logger.warning("Query '%s' scans the whole %s collection.", name, cursor.collection.name)
 
-            print('Resolved', len(resolved))
-            print('Outdated', len(outdated))
-            print('Not exist resolver', len(not_exist_resolver))
 
-    except RuntimeError as e:
-        logger.error(e)
+def outdate(my_ad):
+    """ Only collects the stored ads which were not crawled, they are marked outdated at the end of the cycle. """
+    if 'outdated' in my_ad:
+        return
+    missing.append({'_id': my_ad['_id'], 'url': my_ad['url']})
+
+
+def site_url(site):
+    return site['url'] if isinstance(site, dict) else site
+
+
+def site_interval(site):
+    if isinstance(site, dict) and 'interval' in site:
+        return site['interval']
+    return config['restart'] if 'restart' in config else 0
+
+
+def site_scope(url):
+    """
+    Prefix of the stored ad urls listed under a site url,
+    "https://www.ss.com/lv/real-estate/flats/riga/centre/sell/" -> "real-estate/flats/riga/centre/".
+    """
+    path = [p for p in urlparse(url).path.split('/') if p][1:-1]
+    if 'all' in path:
+        path = path[:path.index('all')]
+    return '/'.join(path) + '/'
+
+
+def scope_pattern(sites):
+    return '^(?:%s)' % '|'.join(re.escape(site_scope(url)) for url in sites)
+
+
+def scope_query(sites):
+    """ Limits stored ads to the given sites, or to nothing when all configured sites are checked. """
+    if set(sites) >= {site_url(site) for site in config["sites"]}:
+        return {}
+    return {'url': {'$regex': scope_pattern(sites)}}
+
+
+# Geocoding results cached across cycles.
+geo = None
+
+
+def create_geocache(db):
+    """ Without google.key only addresses already in the geodata collection, keyed or backfilled, are resolved. """
+    key = config['google.key'] if 'google.key' in config else ''
+    geocoder = geodata.google_geocoder(key, timeout=session.timeout) if key else None
+    geo = geodata.GeoCache(db[geodata_collection], geocoder,
+                           config['geodata.cache.size'] if 'geodata.cache.size' in config else 10000)
+    geo.ensure_indexes()
+    return geo
+
+
+def site_of(url, scopes):
+    """ The site with the longest scope matching the stored ad url. """
+    matching = [(len(scope), site) for site, scope in scopes.items() if url.startswith(scope)]
+    return max(matching)[1] if matching else None
+
+
+def apply_outdated(collection, ads, stored, partial, scopes):
+    """
+    Marks the missing ads outdated with update_many in chunks.
+    Sites crawled only partially are skipped, as are sites where suspiciously many of the live stored ads
+    went missing at once, more than outdate.max_ratio of them and more than outdate.min_count,
+    which is rather a broken crawl than sold flats.
+    Returns the number of ads marked outdated.
+    """
+    max_ratio = config['outdate.max_ratio'] if 'outdate.max_ratio' in config else 0.5
+    min_count = config['outdate.min_count'] if 'outdate.min_count' in config else 10
+    batch_size = config['db.bulk.size'] if 'db.bulk.size' in config else 1000
+    by_site = {}
+    for ad in ads:
+        by_site.setdefault(site_of(ad['url'], scopes), []).append(ad)
+
+    ids = []
+    for site, site_ads in by_site.items():
+        if site in partial:
+            logger.info("Not outdating %s ads of %s, it was crawled only partially.", len(site_ads), site)
+            continue
+        if len(site_ads) > min_count and len(site_ads) > max_ratio * stored.get(site, 0):
+            logger.error("Not outdating %s of %s stored ads of %s, too many at once.", len(site_ads),
+                         stored.get(site, 0), site)
+            metrics.count('outdate.blocked', site=site)
+            continue
+        for ad in site_ads:
+            events.append('outdated', ad)
+        ids += [ad['_id'] for ad in site_ads]
+
+    for i in range(0, len(ids), batch_size):
+        collection.update_many({'_id': {'$in': ids[i:i + batch_size]}}, {'$set': {'outdated': True}})
+    return len(ids)
+
+
+def run_cycle(myclient, sites):
+    global db, writer, history, events, missing, geo
+    if not sites:
+        logger.info("No sites to check.")
+        return
 
-    if 'restart' in config and config['restart'] > 0:
-        logger.info("Waiting %s seconds.", config['restart'])
-        time.sleep(config['restart'])
-    else:
-        break
+    db = myclient.ss_ads
+    writer = BulkWriter(db[ss_ad_collection], config['db.bulk.size'] if 'db.bulk.size' in config else 1000,
+                        config['db.bulk.ordered'] if 'db.bulk.ordered' in config else False)
+    history = BulkWriter(db[price_history_collection], config['db.bulk.size'] if 'db.bulk.size' in config else 1000)
+    events = EventLog(config['events.file'] if 'events.file' in config else None, events_collection(db),
+                      config['events.batch.size'] if 'events.batch.size' in config else 1000)
+
+    missing = []
+
+    started = time.monotonic()
+    partial = set()
+    remote_index = build_model(request_ss_records(sites, partial))
+    scopes = {site: site_scope(site) for site in sites}
+    stored = {}
+
+    batch_size = config['db.batch.size'] if 'db.batch.size' in config else 1000
+    found = set()
+    by_address = address_index(remote_index)
+    columns = RemoteColumns(remote_index) if columnar else None
+    chunks = stored_ads(db[ss_ad_collection], batch_size, scope_query(sites))
+    while True:
+        with metrics.timer('db.read'):
+            my_ads = next(chunks, None)
+        if my_ads is None:
+            break
+        metrics.count('ads.stored', len(my_ads))
+        for my_ad in my_ads:
+            # Ads outdated long ago would water down the outdate.max_ratio check.
+            if 'outdated' not in my_ad:
+                site = site_of(my_ad['url'], scopes)
+                stored[site] = stored.get(site, 0) + 1
+        with metrics.timer('compare'):
+            if columnar:
+                verify_columnar(my_ads, columns, found, by_address)
+            else:
+                verify_rows(my_ads, remote_index, found, by_address)
+        with metrics.timer('db.write'):
+            writer.flush()
+            history.flush()
+            events.flush()
+
+    with metrics.timer('db.write'):
+        # The set difference of stored and crawled urls, gathered while comparing.
+        apply_outdated(db[ss_ad_collection], missing, stored, partial, scopes)
+        events.flush()
+
+    not_in_db = [remote_index[url] for url in remote_index if url not in found]
+    for remote_ad in not_in_db:
+        logger.debug("Not in DB %s", remote_ad)
+    if geo is None:
+        geo = create_geocache(db)
+    with metrics.timer('geocode'):
+        new_addresses = geo.unknown([remote_ad.address for remote_ad in not_in_db])
+    for address in new_addresses:
+        logger.debug("Not in GeoData DB %s", address)
+
+    events.flush()
+    print('Resolved', events.count('old_'))
+    print('Outdated', events.count('outdated'))
+    print('Not exist resolver', events.count('no_resolver'))
+    print('Not in DB', len(not_in_db))
+    print('New addresses not in GeoData DB', len(new_addresses))
+
+    metrics.observe('cycle', time.monotonic() - started)
+    metrics.count('cycles')
+    metrics.count('outdated', events.count('outdated'))
+    metrics.count('geodata.unknown', len(new_addresses))
+    metrics.count('geodata.geocoded', geo.geocoded)
+    geo.geocoded = 0
+    if 'metrics.file' in config:
+        json_to_file(config['metrics.file'], metrics.snapshot())
+
+
+class Leases:
+    """
+    Shares the sites between worker processes through lease documents in Mongo.
+    Every worker keeps a heartbeat document and holds at most its fair share of the sites,
+    leases which were not renewed within ttl seconds (a dead worker) are taken over by the others.
+    """
+
+    def __init__(self, collection, ttl=900, worker=None):
+        self.collection = collection
+        self.ttl = ttl
+        self.worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+
+    def heartbeat(self, now):
+        self.collection.update_one({'_id': 'worker/' + self.worker},
+                                   {'$set': {'kind': 'worker', 'expires': now + datetime.timedelta(seconds=self.ttl)}},
+                                   upsert=True)
+        return self.collection.count_documents({'kind': 'worker', 'expires': {'$gt': now}})
+
+    def claim(self, site, now):
+        try:
+            lease = self.collection.find_one_and_update(
+                {'_id': site, '$or': [{'owner': self.worker}, {'expires': {'$lt': now}}]},
+                {'$set': {'kind': 'site', 'owner': self.worker, 'expires': now + datetime.timedelta(seconds=self.ttl)}},
+                upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+            return lease['owner'] == self.worker
+        except DuplicateKeyError:
+            # Held by a live worker.
+            return False
+
+    def release(self, site):
+        self.collection.delete_one({'_id': site, 'owner': self.worker})
+
+    def acquire(self, sites):
+        """ Renews the leases of this worker, gives up or claims sites to match its share, returns its sites. """
+        now = datetime.datetime.utcnow()
+        share = -(-len(sites) // max(self.heartbeat(now), 1))
+        owned = {lease['_id'] for lease in self.collection.find({'kind': 'site', 'owner': self.worker})}
+        mine = [site for site in sites if site in owned and self.claim(site, now)]
+        for site in mine[share:]:
+            self.release(site)
+        mine = mine[:share]
+        for site in sites:
+            if len(mine) >= share:
+                break
+            if site not in mine and self.claim(site, now):
+                mine.append(site)
+        return [site for site in sites if site in mine]
+
+    def release_all(self):
+        self.collection.delete_many({'kind': 'site', 'owner': self.worker})
+        self.collection.delete_one({'_id': 'worker/' + self.worker})
+
+
+def run_daemon(myclient, leases=None):
+    """
+    Runs cycles on a fixed cadence, every site on its own interval. Cycles run one after another and never overlap,
+    a site whose slot passed while a cycle was running is checked in the next cycle.
+    With leases only the sites leased by this worker are checked.
+    """
+    intervals = {site_url(site): max(site_interval(site), 1) for site in config["sites"]}
+    next_run = {url: time.monotonic() for url in intervals}
+    while True:
+        try:
+            sites = leases.acquire(list(intervals)) if leases else list(intervals)
+        except PyMongoError as e:
+            # Check nothing until the leases can be renewed, the others take over the sites meanwhile.
+            logger.error(e)
+            sites = []
+        now = time.monotonic()
+        due = [url for url in sites if next_run[url] <= now]
+        if due:
+            try:
+                run_cycle(myclient, due)
+            except (RuntimeError, PyMongoError) as e:
+                logger.error(e)
+            finished = time.monotonic()
+            for url in due:
+                # Keep the cadence: skip the slots that passed while the cycle was running.
+                missed = int((finished - next_run[url]) // intervals[url]) + 1
+                if missed > 1:
+                    logger.warning("Cycle took longer than the %ss interval of %s.", intervals[url], url)
+                next_run[url] += missed * intervals[url]
+        wait = min(next_run[url] for url in sites) - time.monotonic() if sites else min(intervals.values())
+        if leases:
+            # Renew the leases well before they expire.
+            wait = min(wait, leases.ttl / 3)
+        if wait > 0:
+            logger.info("Waiting %.0f seconds.", wait)
+            time.sleep(wait)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verifies stored ss.com ads against the current listings.')
+    parser.add_argument('--explain', action='store_true', help='print query plans of the verification queries and exit')
+    parser.add_argument('--workers', type=int, help='number of processes parsing the downloaded pages')
+    parser.add_argument('--record', metavar='FOLDER', help='save every fetched page into FOLDER')
+    parser.add_argument('--replay', metavar='FOLDER', help='read pages recorded with --record instead of ss.com')
+    parser.add_argument('--db-url', help='overrides db.url, mongomock:// runs against an in-memory database')
+    parser.add_argument('--migrate-history', action='store_true',
+                        help='move the old_price records of the ads collection into the price history and exit')
+    parser.add_argument('--shard', action='store_true',
+                        help='share the sites with other running workers through leases in Mongo')
+    args = parser.parse_args()
+    if args.workers:
+        config['parse.workers'] = args.workers
+    if args.db_url:
+        config['db.url'] = args.db_url
+    if args.record or args.replay:
+        if args.record and not os.path.exists(args.record):
+            os.makedirs(args.record)
+        session = create_session(args.record, args.replay)
+        # Conditional requests answered 304 would leave their pages out of the recording.
+        cache = None
+    if args.replay:
+        # No politeness needed towards files on disk.
+        config['crawl.delay'] = 0
+
+    if 'metrics.port' in config and config['metrics.port']:
+        metrics.serve(config['metrics.port'])
+
+    # One pooled client for the lifetime of the process.
+    with create_client(config["db.url"]) as myclient:
+        ensure_indexes(myclient.ss_ads[ss_ad_collection])
+        price_history.ensure_indexes(myclient.ss_ads[price_history_collection])
+        if args.explain:
+            explain(myclient.ss_ads[ss_ad_collection], myclient.ss_ads[price_history_collection])
+            exit()
+        if args.migrate_history:
+            print('Migrated', price_history.migrate(myclient.ss_ads[ss_ad_collection],
+                                                    myclient.ss_ads[price_history_collection], normalize))
+            exit()
+
+        leases = None
+        if args.shard or is_property('shard.enabled'):
+            leases = Leases(myclient.ss_ads[config['lease_collection'] if 'lease_collection' in config else 'leases'],
+                            config['shard.lease_ttl'] if 'shard.lease_ttl' in config else 3 * site_interval({}) or 900)
+            logger.info("Working as %s.", leases.worker)
+
+        try:
+            if 'restart' in config and config['restart'] > 0:
+                run_daemon(myclient, leases)
+            else:
+                sites = [site_url(site) for site in config["sites"]]
+                try:
+                    run_cycle(myclient, leases.acquire(sites) if leases else sites)
+                except (RuntimeError, PyMongoError) as e:
+                    logger.error(e)
+        finally:
+            if leases:
+                try:
+                    leases.release_all()
+                except PyMongoError as e:
+                    # The leases expire after ttl seconds anyway.
+                    logger.error(e)
@@ -0,0 +1,34 @@
+import ssverification
+from ssverification import RemoteAd, address_index, find_by_url
+
+
+def crawled(*ads):
+    index = {}
+    for url, address in ads:
+        a = RemoteAd()
+        a.url, a.address = url, address
+        ssverification.to_index(index, a)
+    return index
+
+
+index = crawled(('real-estate/flats/riga/centre/abcde.html', 'Brīvības 1'),
+                ('real-estate/flats/riga/teika/fghij.html', 'Brīvības 1'),
+                ('real-estate/flats/riga/teika/klmno.html', 'Gaujas 2'))
+by_address = address_index(index)
+
+
+def test_url_is_the_match():
+    # The listed address may be spelled differently from the stored one.
+    a = find_by_url('real-estate/flats/riga/centre/abcde.html', ['Brīvības iela 1'], index, by_address)
+    assert a.url == 'real-estate/flats/riga/centre/abcde.html'
+
+
+def test_moved_ad_is_found_by_address():
+    a = find_by_url('real-estate/flats/riga/centre/fghij.html', ['Brīvības 1'], index, by_address)
+    assert a.url == 'real-estate/flats/riga/teika/fghij.html'
+    assert find_by_url('real-estate/flats/riga/centre/fghij.html', ['Brīvības 1'], index) is None
+
+
+def test_other_ads_at_the_address_do_not_match():
+    assert find_by_url('real-estate/flats/riga/centre/pqrst.html', ['Brīvības 1'], index, by_address) is None
+    assert find_by_url('real-estate/flats/riga/centre/klmno.html', ['Brīvības 1'], index, by_address) is None
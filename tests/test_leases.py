@@ -0,0 +1,70 @@
+import datetime
+
+import mongomock
+import pytest
+
+from ssverification import Leases
+
+sites = [f"site{i}" for i in range(6)]
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().ss_ads.leases
+
+
+def expire(collection, worker):
+    """ Lets the heartbeat and the leases of a worker run out, as if it died. """
+    past = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    collection.update_many({'$or': [{'_id': 'worker/' + worker}, {'owner': worker}]}, {'$set': {'expires': past}})
+
+
+def test_single_worker_holds_all_sites(collection):
+    assert Leases(collection, worker='w1').acquire(sites) == sites
+
+
+def test_fair_share_on_join(collection):
+    w1, w2, w3 = (Leases(collection, worker=w) for w in ['w1', 'w2', 'w3'])
+    assert w1.acquire(sites) == sites
+    # The joining worker finds every site held, until the others give up what is above their share.
+    assert w2.acquire(sites) == []
+    assert w3.acquire(sites) == []
+    first = w1.acquire(sites)
+    assert len(first) == 2
+    second = w2.acquire(sites)
+    assert len(second) == 2
+    third = w3.acquire(sites)
+    assert len(third) == 2
+    assert sorted(first + second + third) == sites
+
+
+def test_release_above_share(collection):
+    w1, w2 = Leases(collection, worker='w1'), Leases(collection, worker='w2')
+    w1.acquire(sites)
+    w2.heartbeat(datetime.datetime.utcnow())
+    kept = w1.acquire(sites)
+    assert kept == sites[:3]
+    assert collection.count_documents({'kind': 'site', 'owner': 'w1'}) == 3
+    assert collection.count_documents({'kind': 'site'}) == 3
+    assert w2.acquire(sites) == sites[3:]
+
+
+def test_takeover_after_ttl(collection):
+    w1, w2 = Leases(collection, worker='w1'), Leases(collection, worker='w2')
+    w1.acquire(sites)
+    w2.acquire(sites)
+    w1.acquire(sites)
+    assert w2.acquire(sites) == sites[3:]
+    # Live leases are not taken over.
+    assert w2.claim(sites[0], datetime.datetime.utcnow()) is False
+    expire(collection, 'w1')
+    assert w2.acquire(sites) == sites
+    assert collection.count_documents({'kind': 'site', 'owner': 'w2'}) == len(sites)
+
+
+def test_release_all(collection):
+    w1, w2 = Leases(collection, worker='w1'), Leases(collection, worker='w2')
+    w1.acquire(sites)
+    w1.release_all()
+    assert collection.count_documents({'owner': 'w1'}) == 0
+    assert w2.acquire(sites) == sites
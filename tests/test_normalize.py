@@ -0,0 +1,73 @@
+import pytest
+from bson import ObjectId
+
+import ssverification
+from ssverification import RemoteAd, normalize, to_level, to_number
+
+
+@pytest.mark.parametrize('value, number', [
+    ('125 000 €', 125000),
+    ('125\xa0000 €', 125000),
+    ('65,000 €', 65000),
+    ('1.250.000 €', 1250000),
+    ('1,234.5', 1234.5),
+    ('45.5', 45.5),
+    ('45,5', 45.5),
+    ('3', 3),
+    (92000, 92000),
+    ('Citi', 'Citi'),
+])
+def test_to_number(value, number):
+    assert to_number(value) == number
+    assert type(to_number(value)) is type(number)
+
+
+@pytest.mark.parametrize('value, level', [
+    ('3/5', [3, 5]),
+    ('3 / 5', [3, 5]),
+    ((3, 5), [3, 5]),
+    ('2', 2),
+    ('Citi', 'Citi'),
+])
+def test_to_level(value, level):
+    assert to_level(value) == level
+
+
+@pytest.fixture
+def verification(monkeypatch):
+    """ Writer, history and event log without a database, the updates are left in their buffers. """
+    for name in ['writer', 'history']:
+        monkeypatch.setattr(ssverification, name, ssverification.BulkWriter(None, batch_size=10 ** 6), raising=False)
+    monkeypatch.setattr(ssverification, 'events', ssverification.EventLog(), raising=False)
+    return ssverification
+
+
+def remote_ad(**fields):
+    a = RemoteAd()
+    a.url = 'real-estate/flats/riga/centre/abcde.html'
+    a.address = 'Brīvības 1'
+    for key, value in fields.items():
+        setattr(a, key, value)
+    return a
+
+
+def stored_ad(**fields):
+    return dict({'_id': ObjectId(), 'url': 'real-estate/flats/riga/centre/abcde.html', 'address': 'Brīvības 1'},
+                **fields)
+
+
+def test_raw_stored_strings_are_not_changes(verification):
+    raw = {'price': '92,000 €', 'price_m2': '1 314 €', 'm2': '70', 'level': '3/5', 'rooms': '3'}
+    my_ad = stored_ad(**raw)
+    verification.compare(my_ad, remote_ad(**{key: normalize(key, value) for key, value in raw.items()}))
+    assert verification.events.counts == {}
+    assert verification.writer.updates == {}
+    assert verification.history.inserts == []
+
+
+def test_changes_are_resolved(verification):
+    my_ad = stored_ad(price='92,000 €', rooms='3')
+    verification.compare(my_ad, remote_ad(price=89000, rooms='Citi'))
+    assert verification.events.counts == {'old_price': 1}
+    assert verification.writer.updates == {my_ad['_id']: {'price': 89000}}
+    assert [(p['old_price'], p['price']) for p in verification.history.inserts] == [(92000, 89000)]
@@ -0,0 +1,79 @@
+import mongomock
+import pytest
+
+import ssverification
+from geodata import GeoCache
+from ssverification import RemoteAd, apply_outdated, site_scope
+
+site = ssverification.site_url(ssverification.config['sites'][0])
+other = ssverification.site_url(ssverification.config['sites'][1])
+scopes = {url: site_scope(url) for url in [site, other]}
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    monkeypatch.setattr(ssverification, 'events', ssverification.EventLog(), raising=False)
+    return mongomock.MongoClient().ss_ads[ssverification.ss_ad_collection]
+
+
+def store(collection, url, count, **fields):
+    """ Stores count ads under the scope of the site url, returns them as collected by outdate. """
+    ads = [dict({'kind': 'ad', 'url': f"{site_scope(url)}ad{i}.html", 'address': f"Brīvības {i}", 'price': 92000},
+                **fields) for i in range(count)]
+    collection.insert_many(ads)
+    return [{'_id': ad['_id'], 'url': ad['url']} for ad in ads]
+
+
+def blocked(url):
+    return ssverification.metrics.counters.get(('outdate.blocked', (('site', url),)), 0)
+
+
+def outdated(collection):
+    return collection.count_documents({'outdated': True})
+
+
+def test_missing_ads_are_outdated(collection):
+    missing = store(collection, site, 20)[:5]
+    assert apply_outdated(collection, missing, {site: 20}, set(), scopes) == 5
+    assert outdated(collection) == 5
+    assert ssverification.events.counts == {'outdated': 5}
+
+
+def test_partial_site_is_skipped(collection):
+    missing = store(collection, site, 20)[:5] + store(collection, other, 20)[:5]
+    assert apply_outdated(collection, missing, {site: 20, other: 20}, {site}, scopes) == 5
+    assert collection.count_documents({'outdated': True, 'url': {'$regex': '^' + site_scope(other)}}) == 5
+    assert outdated(collection) == 5
+
+
+def test_too_many_missing_is_blocked(collection):
+    before = blocked(site)
+    missing = store(collection, site, 30)[:20]
+    assert apply_outdated(collection, missing, {site: 30}, set(), scopes) == 0
+    assert outdated(collection) == 0
+    assert blocked(site) == before + 1
+
+
+def test_few_missing_are_outdated_whatever_the_ratio(collection):
+    missing = store(collection, site, 10)
+    assert apply_outdated(collection, missing, {site: 10}, set(), scopes) == 10
+
+
+def test_outdated_ads_do_not_water_down_the_ratio(monkeypatch, collection):
+    live = store(collection, site, 30)
+    store(collection, site, 100, outdated=True)
+    crawled = {}
+    for ad in collection.find({'_id': {'$in': [a['_id'] for a in live[20:]]}}):
+        a = RemoteAd()
+        a.url, a.address, a.price, a.fingerprint = ad['url'], ad['address'], ad['price'], 'unchanged'
+        crawled[a.url] = a
+    monkeypatch.setattr(ssverification, 'request_ss_records', lambda sites, partial: iter([]))
+    monkeypatch.setattr(ssverification, 'build_model', lambda rows: crawled)
+    monkeypatch.setattr(ssverification, 'geo', GeoCache(collection.database.geodata))
+    before = blocked(site)
+
+    ssverification.run_cycle(collection.database.client, [site])
+
+    # 20 of the 30 live ads went missing, measured against all 130 stored ads it would look like a normal cycle.
+    assert blocked(site) == before + 1
+    assert outdated(collection) == 100
@@ -0,0 +1,50 @@
+import hashlib
+import io
+
+import pytest
+import requests
+
+from utils import PageCache, RequestError
+
+body = 'Rīga, Brīvības iela 1 '.encode() * 1000
+
+
+def response(content=body, status_code=200, etag='"1"'):
+    """ A streamed response, its body is read only once. """
+    r = requests.models.Response()
+    r.status_code = status_code
+    r.headers['ETag'] = etag
+    r.encoding = 'utf-8'
+    r.raw = io.BytesIO(content)
+    return r
+
+
+def parse(chunks):
+    return ''.join(chunks)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PageCache(str(tmp_path) + '/')
+
+
+def test_streamed_page_is_hashed_and_cached(cache):
+    assert cache.stream('a', response(), parse, chunk_size=7) == body.decode()
+    assert cache.entries['a']['hash'] == hashlib.sha1(body).hexdigest()
+    assert cache.headers('a') == {'If-None-Match': '"1"'}
+
+
+def test_not_modified_page_is_not_parsed(cache):
+    cache.stream('a', response(), parse)
+    assert cache.stream('a', response(b'', 304), lambda chunks: pytest.fail('parsed')) == body.decode()
+    assert cache.hits == 1
+
+
+def test_not_modified_page_needs_a_cached_result(cache):
+    with pytest.raises(RequestError):
+        cache.stream('a', response(b'', 304), parse)
+
+
+def test_streamed_and_read_pages_share_the_cache(cache):
+    cache.stream('a', response(), parse)
+    assert cache.result('a', response(), lambda text: pytest.fail('parsed')) == body.decode()
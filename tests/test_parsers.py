@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import ssverification
+import utils
+
+page_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pages', 'listing.html')
+
+
+@pytest.fixture
+def page():
+    with open(page_file, encoding='utf-8') as f:
+        return f.read()
+
+
+def model(monkeypatch, parser, chunks):
+    monkeypatch.setattr(ssverification, 'Parser', parser)
+    rows, pages = ssverification.parse_page(chunks)
+    return {url: a.fields() for url, a in ssverification.build_model(iter(rows)).items()}, pages
+
+
+def test_page_is_parsed(monkeypatch, page):
+    index, pages = model(monkeypatch, utils.MyHTMLParser, page)
+    assert len(index) == 4
+    assert index['real-estate/flats/riga/centre/abcde.html']['price'] == 92000
+    assert ssverification.page_urls(ssverification.config['sites'][0]['url'], pages)[-1].endswith('page3.html')
+
+
+@pytest.mark.parametrize('chunk_size', [7, 64, 4096])
+def test_chunked_feed_gives_same_model(monkeypatch, page, chunk_size):
+    chunks = [page[i:i + chunk_size] for i in range(0, len(page), chunk_size)]
+    assert model(monkeypatch, utils.MyHTMLParser, chunks) == model(monkeypatch, utils.MyHTMLParser, page)
+
+
+def test_lxml_backend_gives_same_model(monkeypatch, page):
+    pytest.importorskip('lxml.html')
+    assert model(monkeypatch, utils.LxmlHTMLParser, page) == model(monkeypatch, utils.MyHTMLParser, page)
+
+
+def test_missing_backend_falls_back(monkeypatch):
+    monkeypatch.setattr(utils, 'lxml', None)
+    assert utils.html_parser('lxml') is utils.MyHTMLParser
+    assert utils.html_parser('selectolax') is utils.MyHTMLParser
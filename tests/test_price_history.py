@@ -0,0 +1,47 @@
+import datetime
+
+import mongomock
+import pytest
+
+import price_history
+
+day = datetime.datetime(2024, 3, 1)
+
+
+@pytest.fixture
+def db():
+    db = mongomock.MongoClient().ss_ads
+    for i in range(5):
+        url = f"real-estate/flats/riga/centre/ad{i}.html"
+        _id = db.ads.insert_one({'kind': 'ad', 'url': url, 'price': 80000, 'price_m2': 1000}).inserted_id
+        db.ads.insert_many([{'kind': 'old_price', 'ad_id': _id, 'price': price, 'date': day + datetime.timedelta(days=d)}
+                            for d, price in enumerate([92000, 85000])])
+    return db
+
+
+def test_migrate(db):
+    assert price_history.migrate(db.ads, db.price_history, batch_size=2) == 10
+    assert db.ads.count_documents({'kind': 'old_price'}) == 0
+    _id = db.ads.find_one({'kind': 'ad'})['_id']
+    assert [(p['old_price'], p['price'], p['price_m2']) for p in price_history.history(db.price_history, _id)] == \
+           [(92000, 85000, None), (85000, 80000, 1000)]
+    assert price_history.median_price_m2(db.price_history, day) == \
+           {('real-estate/flats/riga/centre', (day + datetime.timedelta(days=1)).date()): 1000}
+
+
+def test_interrupted_migration_is_resumed(monkeypatch, db):
+    write_batch = price_history.write_batch
+    batches = []
+
+    def fail_second(*args):
+        if batches:
+            raise RuntimeError('interrupted')
+        batches.append(write_batch(*args))
+        return batches[-1]
+
+    monkeypatch.setattr(price_history, 'write_batch', fail_second)
+    with pytest.raises(RuntimeError):
+        price_history.migrate(db.ads, db.price_history, batch_size=2)
+    monkeypatch.undo()
+    assert price_history.migrate(db.ads, db.price_history, batch_size=2) == 10 - batches[0]
+    assert db.price_history.count_documents({}) == 10
@@ -8,12 +8,26 @@ Version 1.0
 """
 
 from html.parser import HTMLParser
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import hashlib
 import logging
 import requests
 import json
 import os
+import pickle
+import time
 import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
 
 
 """ Logger Configuration """
@@ -60,42 +74,59 @@ class MyHTMLParser(HTMLParser):
         pass
 
     def __init__(self, *args, **kwargs):
-        super(self.__class__, self).__init__()
+        super().__init__()
         self.path = []
+        self.open_tags = {}
         self.data = []
         self.valid_tags = []
         self.skip_tags = []
         self.parsers = {}
         self.current_tag = None
         self.is_current_tag_valid = False
+        self.continues = False
+        self.emit = None
         for arg in args:
             for key in arg:
                 setattr(self, key, arg[key])
+        self.valid_tags = frozenset(self.valid_tags)
+        self.skip_tags = frozenset(self.skip_tags)
         # print("Parsing of tags:", self.valid_tags)
 
     def handle_starttag(self, tag, attrs):
+        self.continues = False
         if tag == 'br':
             return
         self.path.append(tag)
+        self.open_tags[tag] = self.open_tags.get(tag, 0) + 1
         self.is_current_tag_valid = self.valid(tag)
         self.current_tag = tag
         if not self.is_current_tag_valid:
             return
         if self.is_skip(tag):
             return
+        if self.emit and self.data:
+            for d in self.data:
+                self.emit(d)
+            self.data = []
         self.data.append((tag, attrs))
-        super(self.__class__, self).handle_starttag(tag, attrs)
+        super().handle_starttag(tag, attrs)
 
     def handle_endtag(self, tag):
-        i = len(self.path) - 1 - self.path[::-1].index(tag)
-        self.path = self.path[:i]
-
+        self.continues = False
+        # Close the innermost open element with this tag and everything opened after it,
+        # an end tag without a matching open element is ignored.
+        if self.open_tags.get(tag):
+            while True:
+                last = self.path.pop()
+                self.open_tags[last] -= 1
+                if last == tag:
+                    break
 
         self.is_current_tag_valid = self.valid(tag)
         self.current_tag = None
         if not self.is_current_tag_valid:
             return
-        super(self.__class__, self).handle_endtag(tag)
+        super().handle_endtag(tag)
 
     def handle_data(self, data):
         if not self.current_tag or not self.is_current_tag_valid:
@@ -107,13 +138,20 @@ class MyHTMLParser(HTMLParser):
                 self.default_parser(data)
             else:
                 self.parsers[self.current_tag](data, self)
-        super(self.__class__, self).handle_data(data)
+        super().handle_data(data)
+        self.continues = True
+
+    def handle_comment(self, data):
+        self.continues = False
 
     def default_parser(self, data):
         if self.data:
             idx = len(self.data) - 1
             last = self.data[idx]
-            if len(last) > 2:
+            if len(last) > 2 and self.continues:
+                # Text node split across feed() calls.
+                self.data[idx] = last[:-1] + (last[-1] + data,)
+            elif len(last) > 2:
                 self.data[idx] += (data,)
             else:
                 self.data[idx] = (last[0], last[1], data)
@@ -132,6 +170,79 @@ class MyHTMLParser(HTMLParser):
         self.feed(data)
         return self
 
+    def feed_and_iterate(self, chunks):
+        """
+        Streaming mode: feeds text chunks and yields every tuple as soon as it is complete,
+        instead of accumulating them in self.data.
+        """
+        ready = []
+        self.emit = ready.append
+        for chunk in chunks:
+            self.feed(chunk)
+            yield from ready
+            ready.clear()
+        self.close()
+        ready.extend(self.data)
+        self.data = []
+        yield from ready
+
+
+class LxmlHTMLParser(MyHTMLParser):
+    """
+    MyHTMLParser backed by the C parser of lxml.
+    The document is parsed on close() and its tree is replayed as html.parser events,
+    so subclasses and callers see the same tuples in self.data.
+    """
+
+    void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param',
+                           'source', 'track', 'wbr'])
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        text = ''.join(self.chunks)
+        self.chunks = []
+        if text.strip():
+            self.replay(lxml.html.document_fromstring(text))
+
+    def replay(self, el):
+        if not isinstance(el.tag, str):
+            self.handle_comment(el.text)
+        else:
+            self.handle_starttag(el.tag, [(k, v) for k, v in el.attrib.items()])
+            if el.text:
+                self.handle_data(el.text)
+        for child in el:
+            self.replay(child)
+            if child.tail:
+                self.handle_data(child.tail)
+        if isinstance(el.tag, str) and el.tag not in self.void_tags:
+            self.handle_endtag(el.tag)
+
+    def feed_and_return(self, data):
+        self.feed(data)
+        self.close()
+        return self
+
+
+parser_backends = {'html.parser': MyHTMLParser, 'lxml': LxmlHTMLParser}
+
+
+def html_parser(backend='html.parser'):
+    """ Returns the parser class of the backend, falling back to MyHTMLParser when its library is missing. """
+    if backend == 'lxml' and lxml is None:
+        logger.warning("lxml is not installed, falling back to html.parser.")
+        return MyHTMLParser
+    if backend not in parser_backends:
+        logger.warning("Unknown parser backend %s, falling back to html.parser.", backend)
+        return MyHTMLParser
+    return parser_backends[backend]
+
 
 class AnektodHTMLParser(HTMLParser):
     def error(self, message):
@@ -404,15 +515,273 @@ def json_to_file(file_name, data):
 
 
 class _session:
-    def __init__(self):
+    """
+    Shared keep-alive client: pooled connections, retries with backoff on 429/5xx and timeouts.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, pool_size=10, retries=3, backoff=0.5, timeout=(5, 30), record_folder=None):
         super().__init__()
+        self.timeout = timeout
+        self.record_folder = record_folder
+        self.recorded = {}
+        if record_folder and os.path.exists(os.path.join(record_folder, 'index.json')):
+            self.recorded = json_from_file(os.path.join(record_folder, 'index.json'))
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
         self.s = requests.Session()
-
-    def _get(self):
-        pass
-
-    def _post(self):
-        pass
+        self.s.mount('http://', self.adapter)
+        self.s.mount('https://', self.adapter)
+        self.s.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.lock = Lock()
+        self.latencies = []
+        self.counted = (0, 0)
+
+    def _request(self, method, url, **kwargs):
+        started = time.monotonic()
+        r = self.s.request(method, url, timeout=self.timeout, **kwargs)
+        latency = time.monotonic() - started
+        with self.lock:
+            self.latencies.append(latency)
+        logger.debug("%s %s %s %.3fs", method, url, r.status_code, latency)
+        if not r.ok:
+            raise RequestError(r.reason, url)
+        if self.record_folder and method == 'GET' and r.status_code == 200:
+            self.record(url, r)
+        return r
+
+    def record(self, url, r):
+        """ Saves the response body for ReplaySession, streamed responses are read here. """
+        name = hashlib.sha1(url.encode()).hexdigest() + '.html'
+        to_file(os.path.join(self.record_folder, name), r.content)
+        with self.lock:
+            self.recorded[url] = {'file': name, 'encoding': r.encoding}
+            json_to_file(os.path.join(self.record_folder, 'index.json'), self.recorded)
+
+    def _get(self, url, params=None, **kwargs):
+        return self._request('GET', url, params=params, **kwargs)
+
+    def _post(self, url, data=None, **kwargs):
+        return self._request('POST', url, data=data, **kwargs)
+
+    def stats(self, reset=False):
+        connections = 0
+        requests_sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool:
+                connections += pool.num_connections
+                requests_sent += pool.num_requests
+        with self.lock:
+            latencies = self.latencies
+            counted_connections, counted_requests = self.counted
+            if reset:
+                self.latencies = []
+                self.counted = (connections, requests_sent)
+        connections -= counted_connections
+        requests_sent -= counted_requests
+        return {'requests': len(latencies),
+                'connections': connections,
+                'reused': requests_sent - connections,
+                'latency.avg': sum(latencies) / len(latencies) if latencies else 0,
+                'latency.max': max(latencies) if latencies else 0}
+
+
+class ReplaySession(_session):
+    """ Answers GET requests with the pages recorded by _session(record_folder=...), without network access. """
+
+    def __init__(self, folder, **kwargs):
+        super().__init__(**kwargs)
+        self.folder = folder
+        self.pages = json_from_file(os.path.join(folder, 'index.json'), "No recorded pages in %s." % folder)
+
+    def _request(self, method, url, **kwargs):
+        started = time.monotonic()
+        if method != 'GET' or url not in self.pages:
+            raise RequestError(404, "Not recorded %s %s" % (method, url))
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = 'OK'
+        r.url = url
+        r.encoding = self.pages[url]['encoding'] or 'utf-8'
+        r._content = from_file(os.path.join(self.folder, self.pages[url]['file']))
+        r._content_consumed = True
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+        return r
+
+
+class PageCache:
+    """
+    On-disk cache for conditional GET requests.
+    Per url keeps ETag/Last-Modified, a hash of the body and the parsed result,
+    so unchanged pages are neither downloaded nor parsed again.
+    Least recently used entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, folder='requests/', max_entries=1000):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.index_file = os.path.join(folder, 'cache.json')
+        self.lock = Lock()
+        self.hits = 0
+        self.entries = OrderedDict()
+        try:
+            self.entries.update(json_from_file(self.index_file))
+        except Exception as e:
+            logger.debug("Page cache is empty: %s", e)
+
+    def file_name(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode()).hexdigest() + '.pickle')
+
+    def headers(self, url):
+        headers = {}
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and os.path.exists(self.file_name(url)):
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def result(self, url, r, parse):
+        """ Returns parsed content of response r, reusing the cached result when the page did not change. """
+        with self.lock:
+            entry = self.entries.get(url)
+        digest = None if r.status_code == 304 else hashlib.sha1(r.content).hexdigest()
+        if entry and (r.status_code == 304 or entry['hash'] == digest):
+            try:
+                parsed = pickle.loads(from_file(self.file_name(url)))
+                with self.lock:
+                    self.hits += 1
+                    self.entries.move_to_end(url)
+                return parsed
+            except (OSError, pickle.UnpicklingError) as e:
+                logger.debug("Page cache miss for %s: %s", url, e)
+        if r.status_code == 304:
+            raise RequestError(r.status_code, "Not modified, but nothing cached for %s" % url)
+
+        parsed = parse(r.text)
+        self.store(url, r, digest, parsed)
+        return parsed
+
+    def stream(self, url, r, parse, chunk_size=16 * 1024):
+        """
+        Like result, for response r requested with stream=True: the body is parsed while it is downloading
+        and hashed from the same chunks. Only a 304 reuses the cached result, a changed page is parsed once.
+        """
+        if r.status_code == 304:
+            return self.result(url, r, parse)
+        digest = hashlib.sha1()
+
+        def chunks():
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                digest.update(chunk)
+                yield chunk
+
+        parsed = parse(requests.utils.stream_decode_response_unicode(chunks(), r))
+        self.store(url, r, digest.hexdigest(), parsed)
+        return parsed
+
+    def store(self, url, r, digest, parsed):
+        to_file(self.file_name(url), pickle.dumps(parsed))
+        with self.lock:
+            self.entries[url] = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified'),
+                                 'hash': digest}
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                try:
+                    os.remove(self.file_name(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def save(self):
+        with self.lock:
+            json_to_file(self.index_file, self.entries)
+
+
+class Metrics:
+    """
+    Thread safe durations and counters of named stages, optionally labeled (e.g. by url).
+    Exported as a JSON friendly dict or as Prometheus text.
+    """
+
+    def __init__(self, prefix='app'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.timings = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.setdefault(key, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            timing['count'] += 1
+            timing['seconds'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return {'timings': [dict(stage=name, **dict(labels), **timing) for (name, labels), timing in
+                                self.timings.items()],
+                    'counters': [dict(name=name, value=value, **dict(labels)) for (name, labels), value in
+                                 self.counters.items()]}
+
+    def to_prometheus(self):
+        def labels_text(labels):
+            return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+        lines = []
+        with self.lock:
+            for (name, labels), timing in sorted(self.timings.items()):
+                stage = labels_text((('stage', name),) + labels)
+                lines.append('%s_stage_seconds_sum{%s} %f' % (self.prefix, stage, timing['seconds']))
+                lines.append('%s_stage_seconds_count{%s} %d' % (self.prefix, stage, timing['count']))
+                lines.append('%s_stage_seconds_max{%s} %f' % (self.prefix, stage, timing['max']))
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = '%s_%s_total' % (self.prefix, name.replace('.', '_'))
+                lines.append('%s{%s} %s' % (metric, labels_text(labels), value) if labels else '%s %s' % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serves Prometheus text on http://host:port/metrics from a background thread. """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
 
 
 def _get(url, params=None, session=None, log_folder='requests/', *args, **kwargs):
@@ -454,8 +823,9 @@ def _poste(url, params, headers, session=None, *args, **kwargs):
     return r, session
 
 
-def google_geocode(address, components='locality:riga|country:LV', language='ru', key=''):
-    response = requests.get(f'https://maps.googleapis.com/maps/api/geocode/json?address={address}&components={components}&language={language}&key={key}')
+def google_geocode(address, components='locality:riga|country:LV', language='ru', key='', timeout=(5, 30)):
+    response = requests.get(f'https://maps.googleapis.com/maps/api/geocode/json?address={address}&components={components}&language={language}&key={key}',
+                            timeout=timeout)
     if not response.ok:
         raise GoogleError(response.reason)
     else:
@@ -464,7 +834,7 @@ def google_geocode(address, components='locality:riga|country:LV', language='ru'
             if body['status'] in ['OK', 'ZERO_RESULTS']:
                 return body['results']
             else:
-                raise GoogleError(body['status'], body['error_message'])
+                raise GoogleError(body['status'], body.get('error_message'))
 
 
 